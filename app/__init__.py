@@ -1,4 +1,6 @@
-from app.core import App
+# The Qt application lives in app.core, so that the Qt-free modules (mouse targeting, OS backends) import headless
 
 DEFAULT_CYKIT_ADDRESS = 'localhost'
 DEFAULT_CYKIT_PORT = 5151
+# Seconds between the latency and throughput reports the session writes to the session log
+DEFAULT_METRICS_INTERVAL = 10
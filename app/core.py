@@ -1,23 +1,28 @@
 import logging
 import sys
 
-from PySide2.QtCore import Qt, QProcess, QSettings
+from PySide2.QtCore import Qt, QProcess, QSettings, QTimer
 from PySide2.QtGui import QIcon, QPixmap, QTextCursor
 from PySide2.QtWidgets import (
     QAction, QActionGroup, QApplication, QLabel, QMenu, QSystemTrayIcon, QTextBrowser)
 
 import app
+from app.os_interaction import create_backend
 from app.realtime_interaction import InteractionServer
 from app.preferences import PreferencesDialog
-from app.ui import KeyboardUI
+from app.ui import KeyboardUI, MouseUI, QualityUI
 
 logger = logging.getLogger(__name__)
 
+# Time in ms the clicked window gets to react before the screen is captured for the next selection
+CLICK_SETTLE_TIME = 500
+
 
 class App(QApplication):
     def __init__(self, argv):
         super().__init__(argv)
 
+        self._os = create_backend()
         self._create_tray_icon()
         self._create_ui()
         self._create_interaction_server()
@@ -29,16 +34,23 @@ class App(QApplication):
         prefs_dialog.exec()
 
     def _mode_changed(self):
+        mode = 'mouse' if self._input_mouse.isChecked() else 'keyboard'
+        self._keyboard_ui.setVisible(mode == 'keyboard')
+        self._letter_ui.setVisible(mode == 'keyboard')
+        self._mouse_ui.setVisible(mode == 'mouse')
+
         action = self._mode_group.checkedAction()
         if action == self._mode_off:
-            self._stop_session()
-        elif action == self._mode_enabled:
-            self._interaction_server.train = False
-            self._start_session()
-        elif action == self._mode_training:
-            self._interaction_server.train = True
-            self._start_session()
-
+            self._interaction_server.set_mode(active=False, mode=mode)
+            return
+        # The screen is captured before the session starts flashing its quadrants
+        if mode == 'mouse':
+            self._capture_screen()
+        self._interaction_server.set_mode(active=True, train=action == self._mode_training, mode=mode)
+        self._start_session()
+
+    # The session process is started once and then only switched between modes, as importing
+    # its dependencies, loading the model and the CyKit handshake take a few seconds
     def _start_session(self):
         if self._session is not None:
             return
@@ -49,12 +61,18 @@ class App(QApplication):
         self._session.readyReadStandardError.connect(self._log_append_stderr)
 
         settings = QSettings()
-        self._session.start(sys.executable, [
+        args = [
             'run_session.py',
             settings.value('CyKitAddress', app.DEFAULT_CYKIT_ADDRESS),
             str(settings.value('CyKitPort', app.DEFAULT_CYKIT_PORT)),
-            str(self._interaction_server.port)
-        ])
+            str(self._interaction_server.port),
+            # The app times flashes itself, so the session sends whole rounds at once
+            '--schedule',
+            '--metrics-interval', str(settings.value('MetricsInterval', app.DEFAULT_METRICS_INTERVAL))
+        ]
+        if self._interaction_server.socket_path is not None:
+            args += ['--interaction-socket', self._interaction_server.socket_path]
+        self._session.start(sys.executable, args)
 
     def _stop_session(self):
         if self._session is not None:
@@ -64,6 +82,7 @@ class App(QApplication):
     def _session_ended(self):
         self._session = None
         self._mode_off.setChecked(True)
+        self._interaction_server.set_mode(active=False)
 
     def _log_append_stdout(self):
         process = self.sender()
@@ -77,9 +96,37 @@ class App(QApplication):
         self._log_window.insertPlainText(process.readAllStandardError().data().decode('utf-8'))
         self._log_window.moveCursor(QTextCursor.End)
 
+    def _exit(self):
+        self._stop_session()
+        self.exit()
+
+    def _log_flash_timing(self):
+        self._log_window.moveCursor(QTextCursor.End)
+        self._log_window.insertPlainText("Flash timing:\n{}\n".format(self._keyboard_ui.probe.summary()))
+        self._log_window.moveCursor(QTextCursor.End)
+
     def _select_letter(self, letter):
         self._letter_ui.setText(letter)
 
+    # The screen is captured once per mouse selection, zooming in only picks other tiles of the same capture
+    def _capture_screen(self):
+        self._mouse_ui.hide()
+        self.processEvents()
+        self._mouse_ui.set_screenshot(self._os.grab_screen())
+        self._mouse_ui.show()
+
+    def _select_class(self, cls):
+        point = self._mouse_ui.targeting.select(cls)
+        if point is None:
+            self._mouse_ui.refresh()
+            return
+
+        # The overlay must not be in the way of the click
+        screenshot = self._mouse_ui.screenshot
+        self._mouse_ui.hide()
+        self._os.click(screenshot.left + point[0], screenshot.top + point[1])
+        QTimer.singleShot(CLICK_SETTLE_TIME, self._capture_screen)
+
     def _create_tray_icon(self):
         menu = QMenu()
 
@@ -102,10 +149,27 @@ class App(QApplication):
         self._mode_group.addAction(self._mode_training)
         menu.addAction(self._mode_training)
 
+        menu.addSeparator()
+
+        self._input_group = QActionGroup(menu)
+        self._input_group.triggered.connect(self._mode_changed)
+
+        self._input_keyboard = QAction("&Keyboard", parent=menu)
+        self._input_keyboard.setCheckable(True)
+        self._input_keyboard.setChecked(True)
+        self._input_group.addAction(self._input_keyboard)
+        menu.addAction(self._input_keyboard)
+
+        self._input_mouse = QAction("&Mouse", parent=menu)
+        self._input_mouse.setCheckable(True)
+        self._input_group.addAction(self._input_mouse)
+        menu.addAction(self._input_mouse)
+
         menu.addSeparator()
         menu.addAction("&Preferences", self.open_preferences)
+        menu.addAction("Flash &timing", self._log_flash_timing)
         menu.addSeparator()
-        menu.addAction("E&xit", self.exit)
+        menu.addAction("E&xit", self._exit)
 
         pixmap = QPixmap(32, 32)
         pixmap.fill(Qt.white)
@@ -128,6 +192,11 @@ class App(QApplication):
         self._letter_ui.setGeometry(600, 0, 100, 100)
         self._letter_ui.show()
 
+        self._mouse_ui = MouseUI(probe=self._keyboard_ui.probe)
+
+        self._quality_ui = QualityUI()
+        self._quality_ui.show()
+
         # TODO: Replace with more user-friendly log
         self._log_window = QTextBrowser()
         self._log_window.setWindowTitle("Session Log")
@@ -135,8 +204,12 @@ class App(QApplication):
         self._log_window.show()
 
     def _create_interaction_server(self):
-        self._interaction_server = InteractionServer(self)
+        self._interaction_server = InteractionServer(self, self._keyboard_ui.probe)
         self._interaction_server.keyboard_flash_row.connect(self._keyboard_ui.flash_row)
         self._interaction_server.keyboard_flash_col.connect(self._keyboard_ui.flash_col)
         self._interaction_server.keyboard_highlight_letter.connect(self._keyboard_ui.highlight_letter)
         self._interaction_server.keyboard_select_letter.connect(self._select_letter)
+        self._interaction_server.mouse_flash_class.connect(self._mouse_ui.flash_class)
+        self._interaction_server.mouse_highlight_class.connect(self._mouse_ui.highlight_class)
+        self._interaction_server.mouse_select_class.connect(self._select_class)
+        self._interaction_server.channel_quality.connect(self._quality_ui.set_quality)
@@ -0,0 +1,45 @@
+NUM_QUADRANTS = 4
+# The last class clicks the middle of the current region, the others zoom into one of its quadrants
+CLICK_CLASS = NUM_QUADRANTS
+NUM_MOUSE_CLASSES = NUM_QUADRANTS + 1
+# Quadrants smaller than this are clicked right away instead of being zoomed into
+MIN_REGION_SIZE = 16
+
+
+class MouseTargeting:
+    def __init__(self, width, height, min_size=MIN_REGION_SIZE):
+        self.width = width
+        self.height = height
+        self.min_size = min_size
+        self.region = (0, 0, width, height)
+
+    def reset(self):
+        self.region = (0, 0, self.width, self.height)
+
+    def quadrant(self, idx):
+        # Quadrants are numbered left to right, top to bottom
+        x, y, width, height = self.region
+        half_width, half_height = width // 2, height // 2
+        if idx % 2:
+            x, width = x + half_width, width - half_width
+        else:
+            width = half_width
+        if idx // 2:
+            y, height = y + half_height, height - half_height
+        else:
+            height = half_height
+        return x, y, width, height
+
+    def select(self, cls):
+        # Returns the point to click, or None if the selection only zoomed in
+        if cls == CLICK_CLASS:
+            region = self.region
+        else:
+            region = self.quadrant(cls)
+            if min(region[2], region[3]) // 2 >= self.min_size:
+                self.region = region
+                return None
+
+        self.reset()
+        x, y, width, height = region
+        return x + width // 2, y + height // 2
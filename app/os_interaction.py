@@ -1,41 +1,124 @@
-import tempfile
+import logging
+import sys
+from abc import ABC, abstractmethod
 
-import win32con
-import win32com.client as comclt
-from win32gui import GetDesktopWindow, GetWindowDC
-from win32ui import CreateDCFromHandle, CreateBitmap
-from win32api import GetSystemMetrics, SetCursorPos, mouse_event
+import numpy as np
 
+logger = logging.getLogger(__name__)
 
-def get_screenshot():
-    hdesktop = GetDesktopWindow()
-        
-    width = GetSystemMetrics(win32con.SM_CXVIRTUALSCREEN)
-    height = GetSystemMetrics(win32con.SM_CYVIRTUALSCREEN)
-    left = GetSystemMetrics(win32con.SM_XVIRTUALSCREEN)
-    top = GetSystemMetrics(win32con.SM_YVIRTUALSCREEN)
-        
-    hdc = GetWindowDC(hdesktop)
-    source_dc = CreateDCFromHandle(hdc)
-    target_dc = source_dc.CreateCompatibleDC()
 
-    bmp = CreateBitmap()
-    bmp.CreateCompatibleBitmap(source_dc, width, height)
+class Screenshot:
+    def __init__(self, left, top, pixels):
+        # Pixels are RGB rows, left and top place them on the (possibly multi-monitor) desktop
+        self.left = left
+        self.top = top
+        self.pixels = pixels
 
-    target_dc.SelectObject(bmp)
-    target_dc.BitBlt((0, 0), (width, height), source_dc, (left, top), win32con.SRCCOPY)
+    @property
+    def width(self):
+        return self.pixels.shape[1]
 
-    tmp = tempfile.NamedTemporaryFile(suffix='.bmp')
-    bmp.SaveBitmapFile(target_dc, tmp.name)
-    return tmp            
+    @property
+    def height(self):
+        return self.pixels.shape[0]
 
+    def tile(self, x, y, width, height, max_width, max_height):
+        # Large regions are decimated to about twice the requested size before the smooth scaling,
+        # which then only has to touch a fraction of the pixels
+        step = max(1, min(width // (2 * max_width), height // (2 * max_height)))
+        return np.ascontiguousarray(self.pixels[y:y + height:step, x:x + width:step])
 
-def send_keyboard_event(letter):
-    shell = comclt.Dispatch("WScript.Shell")
-    shell.SendKeys(letter)
 
+class OSBackend(ABC):
+    @abstractmethod
+    def grab_screen(self) -> Screenshot:
+        pass
 
-def send_mouse_event(x, y):
-    SetCursorPos((x, y))
-    mouse_event(win32con.MOUSEEVENTF_LEFTDOWN, x, y, 0, 0)
-    mouse_event(win32con.MOUSEEVENTF_LEFTUP, x, y, 0, 0)
\ No newline at end of file
+    @abstractmethod
+    def click(self, x, y):
+        pass
+
+    @abstractmethod
+    def send_keys(self, text):
+        pass
+
+
+class WindowsBackend(OSBackend):
+    def __init__(self):
+        import win32api
+        import win32con
+        import win32gui
+        import win32ui
+        import win32com.client
+        self._win32api, self._win32con, self._win32gui, self._win32ui = win32api, win32con, win32gui, win32ui
+        self._shell = win32com.client.Dispatch("WScript.Shell")
+
+    def grab_screen(self):
+        win32api, win32con, win32gui, win32ui = self._win32api, self._win32con, self._win32gui, self._win32ui
+        hdesktop = win32gui.GetDesktopWindow()
+
+        width = win32api.GetSystemMetrics(win32con.SM_CXVIRTUALSCREEN)
+        height = win32api.GetSystemMetrics(win32con.SM_CYVIRTUALSCREEN)
+        left = win32api.GetSystemMetrics(win32con.SM_XVIRTUALSCREEN)
+        top = win32api.GetSystemMetrics(win32con.SM_YVIRTUALSCREEN)
+
+        hdc = win32gui.GetWindowDC(hdesktop)
+        source_dc = win32ui.CreateDCFromHandle(hdc)
+        target_dc = source_dc.CreateCompatibleDC()
+        bmp = win32ui.CreateBitmap()
+        try:
+            bmp.CreateCompatibleBitmap(source_dc, width, height)
+            target_dc.SelectObject(bmp)
+            target_dc.BitBlt((0, 0), (width, height), source_dc, (left, top), win32con.SRCCOPY)
+            # The bitmap is read straight from memory as top-down BGRX rows
+            bits = np.frombuffer(bmp.GetBitmapBits(True), dtype=np.uint8).reshape(height, width, 4)
+            return Screenshot(left, top, np.ascontiguousarray(bits[:, :, 2::-1]))
+        finally:
+            win32gui.DeleteObject(bmp.GetHandle())
+            target_dc.DeleteDC()
+            source_dc.DeleteDC()
+            win32gui.ReleaseDC(hdesktop, hdc)
+
+    def click(self, x, y):
+        self._win32api.SetCursorPos((x, y))
+        self._win32api.mouse_event(self._win32con.MOUSEEVENTF_LEFTDOWN, x, y, 0, 0)
+        self._win32api.mouse_event(self._win32con.MOUSEEVENTF_LEFTUP, x, y, 0, 0)
+
+    def send_keys(self, text):
+        self._shell.SendKeys(text)
+
+
+class FakeBackend(OSBackend):
+    def __init__(self, width=1920, height=1080, left=0, top=0):
+        # A gradient stands in for the desktop, and input events are only recorded
+        x = np.linspace(0, 255, width, dtype=np.uint8)
+        y = np.linspace(0, 255, height, dtype=np.uint8)
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        pixels[:, :, 0] = x[None, :]
+        pixels[:, :, 1] = y[:, None]
+        pixels[:, :, 2] = 128
+        self.screenshot = Screenshot(left, top, pixels)
+        self.grabs = 0
+        self.clicks = []
+        self.keys = []
+
+    def grab_screen(self):
+        self.grabs += 1
+        return self.screenshot
+
+    def click(self, x, y):
+        self.clicks.append((x, y))
+
+    def send_keys(self, text):
+        self.keys.append(text)
+
+
+def create_backend(name=None):
+    if name is None:
+        name = 'windows' if sys.platform == 'win32' else 'fake'
+    if name == 'windows':
+        return WindowsBackend()
+    if name == 'fake':
+        logger.warning("Using a fake desktop, mouse clicks and keys are not sent anywhere")
+        return FakeBackend()
+    raise ValueError("Unknown OS backend: {}".format(name))
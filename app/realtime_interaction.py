@@ -1,10 +1,17 @@
-import json
-import struct
+import logging
+import os
+import sys
 
 from PySide2.QtCore import QObject, Signal
-from PySide2.QtNetwork import QHostAddress, QTcpServer
+from PySide2.QtNetwork import QAbstractSocket, QHostAddress, QLocalServer, QTcpServer
 
-LENGTH_STRUCT = struct.Struct('N')
+from app.scheduling import FlashScheduler
+from protocol import (
+    CONFIG, FLAG_PUSH, QUALITY, REQUEST_CONFIG, SCHEDULE, FrameDecoder, ProtocolError,
+    decode_quality, decode_schedule, decode_signal, encode_batch, encode_flash_ack, encode_json)
+from protocol.timing import now
+
+logger = logging.getLogger(__name__)
 
 
 class InteractionServer(QObject):
@@ -15,40 +22,104 @@ class InteractionServer(QObject):
     mouse_flash_class = Signal(int)
     mouse_highlight_class = Signal(int)
     mouse_select_class = Signal(int)
+    channel_quality = Signal(list)
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, probe=None):
         super().__init__(parent)
+        self.probe = probe
 
         self._tcp_server = QTcpServer(self)
         self._tcp_server.listen(QHostAddress('localhost'))
         self._tcp_server.newConnection.connect(self._handle_new_connection)
 
         self.port = self._tcp_server.serverPort()
+        self.mode = 'keyboard'
+        self.active = False
         self.train = False
 
+        # asyncio only speaks to Unix domain sockets, not to the named pipes QLocalServer uses on Windows
+        self.socket_path = None
+        if sys.platform != 'win32':
+            self._local_server = QLocalServer(self)
+            if self._local_server.listen('bci-interaction-{}'.format(os.getpid())):
+                self._local_server.newConnection.connect(self._handle_new_local_connection)
+                self.socket_path = self._local_server.fullServerName()
+
+        self._decoders = {}
+        self._schedulers = {}
+
+    def set_mode(self, active, train=False, mode=None):
+        # The session keeps running while switched off and waits for the next pushed config
+        self.active, self.train = active, train
+        if mode is not None:
+            self.mode = mode
+        # The session cancels its iteration, but the rest of a round may already be scheduled here
+        for scheduler in self._schedulers.values():
+            scheduler.clear()
+        for socket in self._decoders:
+            self._send_frames(socket, [encode_json(CONFIG, self._config(), FLAG_PUSH)])
+
+    def _config(self):
+        return {
+            'mode': self.mode,
+            'active': self.active,
+            'train': self.train
+        }
+
     def _handle_new_connection(self):
         connection = self._tcp_server.nextPendingConnection()
+        connection.setSocketOption(QAbstractSocket.LowDelayOption, 1)
+        self._add_connection(connection)
+
+    def _handle_new_local_connection(self):
+        self._add_connection(self._local_server.nextPendingConnection())
+
+    def _add_connection(self, connection):
+        self._decoders[connection] = FrameDecoder()
+        self._schedulers[connection] = FlashScheduler(
+            self._emit, self._report_onsets(connection), self.probe, connection)
         connection.readyRead.connect(self._handle_ready_read)
+        connection.disconnected.connect(self._handle_disconnected)
+
+    def _handle_disconnected(self):
+        self._decoders.pop(self.sender(), None)
+        self._schedulers.pop(self.sender(), None)
 
     def _handle_ready_read(self):
         socket = self.sender()
-        while not socket.atEnd():
-            length = LENGTH_STRUCT.unpack(socket.read(LENGTH_STRUCT.size).data())[0]
-            payload = socket.read(length).data()
-            message = json.loads(payload.decode('utf-8'))
-            self._handle_message(socket, message)
-
-    def _send_message(self, socket, message):
-        payload = json.dumps(message).encode('utf-8')
-        socket.write(LENGTH_STRUCT.pack(len(payload)) + payload)
-        socket.flush()
-
-    def _handle_message(self, socket, message):
-        if message['action'] == 'request_config':
-            self._send_message(socket, {
-                'mode': 'keyboard',
-                'train': self.train
-            })
-        elif message['action'] == 'signal':
-            signal = getattr(self, message['signal'])
-            signal.emit(*message['args'])
+        try:
+            frames = self._decoders[socket].feed(socket.readAll().data())
+            responses = [self._handle_frame(socket, *frame) for frame in frames]
+        except ProtocolError:
+            logger.exception("Dropping connection after a malformed message")
+            socket.abort()
+            return
+
+        self._send_frames(socket, [r for r in responses if r is not None])
+
+    def _send_frames(self, socket, frames):
+        if frames:
+            socket.write(frames[0] if len(frames) == 1 else encode_batch(frames))
+            socket.flush()
+
+    def _report_onsets(self, socket):
+        return lambda onsets: self._send_frames(socket, [encode_flash_ack(*onset) for onset in onsets])
+
+    def _emit(self, name, *args):
+        getattr(self, name).emit(*args)
+
+    def _handle_frame(self, socket, opcode, flags, payload):
+        if opcode == REQUEST_CONFIG:
+            return encode_json(CONFIG, self._config())
+        if opcode == SCHEDULE:
+            self._schedulers[socket].schedule(decode_schedule(payload))
+            return None
+        if opcode == QUALITY:
+            self.channel_quality.emit(decode_quality(payload))
+            return None
+
+        name, args, ack = decode_signal(opcode, flags, payload)
+        self._emit(name, *args)
+        # Slots are connected directly and repaint synchronously, so the flash is on screen by now
+        if ack is not None:
+            return encode_flash_ack(ack, now())
@@ -0,0 +1,57 @@
+from collections import deque
+
+from PySide2.QtCore import QObject, Qt, QTimer
+
+from protocol.timing import now
+
+# Qt timers only have millisecond resolution, so they fire this early and the rest is waited out
+SPIN_TIME = 0.002
+
+
+class FlashScheduler(QObject):
+    def __init__(self, flash, report, probe=None, parent=None):
+        super().__init__(parent)
+        self._flash = flash
+        self._report = report
+        self.probe = probe
+
+        self._entries = deque()
+        self._onsets = []
+
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._run_due)
+
+    def schedule(self, entries):
+        self._entries.extend(sorted(entries, key=lambda entry: entry[3]))
+        self._start_timer()
+
+    def clear(self):
+        # Flashes still planned are dropped, e.g. when the app is switched off in the middle of a round
+        self._entries.clear()
+        self._timer.stop()
+
+    def _start_timer(self):
+        if not self._entries:
+            return
+        delay = self._entries[0][3] - now() - SPIN_TIME
+        self._timer.start(max(0, int(delay * 1000)))
+
+    def _run_due(self):
+        while self._entries and self._entries[0][3] - now() < SPIN_TIME:
+            flash_id, name, idx, onset = self._entries.popleft()
+            while now() < onset:
+                pass
+            # Slots repaint synchronously, so the flash is on screen once this returns
+            self._flash(name, idx)
+            self._onsets.append((flash_id, now()))
+            if self.probe is not None:
+                self.probe.observe('onset_delay', self._onsets[-1][1] - onset)
+
+        # Onsets flashed by this timer shot are reported right away, while their epochs are still
+        # being recorded, so that the session can align them before they complete
+        if self._onsets:
+            onsets, self._onsets = self._onsets, []
+            self._report(onsets)
+        self._start_timer()
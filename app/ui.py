@@ -1,27 +1,135 @@
+from collections import defaultdict, deque
 from functools import partial
 
-from PySide2.QtCore import Qt, QTimer
-from PySide2.QtWidgets import QGridLayout, QLabel, QWidget
+import numpy as np
+from PySide2.QtCore import QRect, Qt, QTimer
+from PySide2.QtGui import QColor, QFont, QImage, QPainter, QPixmap
+from PySide2.QtWidgets import QWidget
+
+from app.mouse import CLICK_CLASS, NUM_MOUSE_CLASSES, MouseTargeting
+from protocol.timing import now
 
 LETTERS = ['ABCDEF', 'GHIJKL', 'MNOPQR', 'STUVWX', 'YZ0123', '456789']
 NUM_ROWS = len(LETTERS)
 NUM_COLS = len(LETTERS[0])
 
+NORMAL, FLASHED, HIGHLIGHTED = range(3)
+# Background and text color for every cell state
+CELL_COLORS = {
+    NORMAL: (Qt.black, Qt.white),
+    FLASHED: (Qt.white, Qt.black),
+    HIGHLIGHTED: (Qt.red, Qt.black),
+}
+# Screen tiles are tinted instead of recolored
+TILE_TINTS = {
+    FLASHED: QColor(255, 255, 255, 160),
+    HIGHLIGHTED: QColor(255, 0, 0, 120),
+}
+# Share of the mouse UI height taken by the click button below the quadrants
+CLICK_HEIGHT = 1 / 6
 
-class KeyboardUI(QWidget):
-    def __init__(self, parent=None):
+# Emotiv EPOC+ channel order, as streamed by CyKit
+CHANNEL_NAMES = ['AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4']
+# Name and color of every channel quality status reported by the session
+CHANNEL_STATUSES = [
+    ("good", QColor(0, 160, 0)),
+    ("flat", QColor(Qt.gray)),
+    ("noisy", QColor(220, 160, 0)),
+    ("artifacts", QColor(200, 0, 0)),
+]
+
+
+class FrameProbe:
+    def __init__(self, size=1024):
+        self._values = defaultdict(partial(deque, maxlen=size))
+
+    def observe(self, name, value):
+        self._values[name].append(value)
+
+    def summary(self):
+        lines = []
+        for name, values in sorted(self._values.items()):
+            ms = np.abs(np.fromiter(values, dtype=np.float64)) * 1000.0
+            lines.append("{}: n={} p50={:.2f}ms p95={:.2f}ms max={:.2f}ms".format(
+                name, len(ms), np.percentile(ms, 50), np.percentile(ms, 95), ms.max()))
+        return '\n'.join(lines)
+
+
+class GridUI(QWidget):
+    def __init__(self, num_cells, parent=None, probe=None):
         super().__init__(parent)
+        self.probe = probe if probe is not None else FrameProbe()
+
+        # Overlapping flashes (e.g. of a row and a column) keep their shared cell lit until both end
+        self._num_cells = num_cells
+        self._flash_counts = np.zeros(num_cells, dtype=int)
+        self._highlight_counts = np.zeros(num_cells, dtype=int)
+        self._pixmaps = {}
+        self._flash_requested = None
+
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+
+    def _flash_indices(self, indices, state=FLASHED, flash_time=100):
+        counts = self._highlight_counts if state == HIGHLIGHTED else self._flash_counts
+        counts[indices] += 1
+        self._flash_requested = now()
+        # Flashes are drawn right away, so that the flash is on screen when this returns
+        self.repaint(self._dirty_rect(indices))
+        QTimer.singleShot(flash_time, partial(self._end_flash, indices, counts))
+
+    def _end_flash(self, indices, counts):
+        counts[indices] -= 1
+        self.update(self._dirty_rect(indices))
+
+    def _cell_rect(self, idx):
+        raise NotImplementedError
+
+    def _render(self, idx, state, size):
+        raise NotImplementedError
+
+    def _dirty_rect(self, indices):
+        rect = QRect()
+        for idx in indices:
+            rect = rect.united(self._cell_rect(idx))
+        return rect
+
+    def _state(self, idx):
+        if self._highlight_counts[idx]:
+            return HIGHLIGHTED
+        return FLASHED if self._flash_counts[idx] else NORMAL
+
+    def resizeEvent(self, event):
+        # Cells are only rendered when their size changes, painting just copies pixmaps
+        self._pixmaps.clear()
+        super().resizeEvent(event)
+
+    def _pixmap(self, idx, state):
+        key = idx, state
+        if key not in self._pixmaps:
+            self._pixmaps[key] = self._render(idx, state, self._cell_rect(idx).size())
+        return self._pixmaps[key]
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(event.rect(), Qt.black)
+        for idx in range(self._num_cells):
+            rect = self._cell_rect(idx)
+            if rect.intersects(event.rect()):
+                painter.drawPixmap(rect.topLeft(), self._pixmap(idx, self._state(idx)))
+        painter.end()
+
+        if self._flash_requested is not None:
+            self.probe.observe('flash_paint', now() - self._flash_requested)
+            self._flash_requested = None
+
 
-        layout = QGridLayout(self)
-        for i in range(NUM_ROWS * NUM_COLS):
-            row, col = i // NUM_COLS, i % NUM_COLS
-            label = QLabel(LETTERS[row][col], parent=self)
-            label.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
-            layout.addWidget(label, row, col)
-        self.setLayout(layout)
+class KeyboardUI(GridUI):
+    def __init__(self, parent=None, probe=None):
+        super().__init__(NUM_ROWS * NUM_COLS, parent, probe)
 
         self.setWindowTitle("Keyboard UI")
-        self.setStyleSheet('background-color: black; color: white; font-size: 72pt')
+        self._font = QFont(self.font())
+        self._font.setPointSize(72)
 
         # TODO: Position at center
         self.setGeometry(0, 0, 600, 600)
@@ -38,14 +146,129 @@ class KeyboardUI(QWidget):
         row = [letter in x for x in LETTERS].index(True)
         col = LETTERS[row].index(letter)
         idx = row * NUM_COLS + col
-        self._flash_indices([idx], 'red', show_time)
+        self._flash_indices([idx], HIGHLIGHTED, show_time)
 
-    def _flash_indices(self, indices, color='white', flash_time=100):
-        for cur in indices:
-            widget = self.layout().itemAt(cur).widget()
-            widget.setStyleSheet('background-color: {}; color: black'.format(color))
-        QTimer.singleShot(flash_time, partial(self._end_flash, indices))
+    def _cell_rect(self, idx):
+        row, col = divmod(idx, NUM_COLS)
+        width, height = self.width() // NUM_COLS, self.height() // NUM_ROWS
+        return QRect(col * width, row * height, width, height)
 
-    def _end_flash(self, indices):
-        for idx in indices:
-            self.layout().itemAt(idx).widget().setStyleSheet('')
+    def _render(self, idx, state, size):
+        background, foreground = CELL_COLORS[state]
+        pixmap = QPixmap(size)
+        pixmap.fill(QColor(background))
+        painter = QPainter(pixmap)
+        painter.setPen(QColor(foreground))
+        painter.setFont(self._font)
+        letter = LETTERS[idx // NUM_COLS][idx % NUM_COLS]
+        painter.drawText(pixmap.rect(), Qt.AlignHCenter | Qt.AlignVCenter, letter)
+        painter.end()
+        return pixmap
+
+
+class MouseUI(GridUI):
+    def __init__(self, parent=None, probe=None):
+        super().__init__(NUM_MOUSE_CLASSES, parent, probe)
+        self.screenshot = None
+        self.targeting = None
+        # Scaled screen tiles are shared by all states of a quadrant
+        self._tiles = {}
+
+        self.setWindowTitle("Mouse UI")
+        self._font = QFont(self.font())
+        self._font.setPointSize(36)
+
+        self.setGeometry(0, 0, 600, 600)
+
+    def set_screenshot(self, screenshot):
+        # Every selection starts from the whole screen
+        self.screenshot = screenshot
+        self.targeting = MouseTargeting(screenshot.width, screenshot.height)
+        self.refresh()
+
+    def refresh(self):
+        # The targeting region changed, so every quadrant shows another part of the screenshot
+        self._tiles.clear()
+        self._pixmaps.clear()
+        self.update()
+
+    def flash_class(self, idx):
+        self._flash_indices([idx])
+
+    def highlight_class(self, idx, show_time=4000):
+        self._flash_indices([idx], HIGHLIGHTED, show_time)
+
+    def resizeEvent(self, event):
+        self._tiles.clear()
+        super().resizeEvent(event)
+
+    def _cell_rect(self, idx):
+        grid_height = int(self.height() * (1 - CLICK_HEIGHT))
+        if idx == CLICK_CLASS:
+            return QRect(0, grid_height, self.width(), self.height() - grid_height)
+        width, height = self.width() // 2, grid_height // 2
+        return QRect((idx % 2) * width, (idx // 2) * height, width, height)
+
+    def _render(self, idx, state, size):
+        if idx == CLICK_CLASS:
+            background, foreground = CELL_COLORS[state]
+            pixmap = QPixmap(size)
+            pixmap.fill(QColor(background))
+            painter = QPainter(pixmap)
+            painter.setPen(QColor(foreground))
+            painter.setFont(self._font)
+            painter.drawText(pixmap.rect(), Qt.AlignHCenter | Qt.AlignVCenter, "Click")
+            painter.end()
+            return pixmap
+
+        pixmap = QPixmap(size)
+        pixmap.fill(Qt.black)
+        painter = QPainter(pixmap)
+        if self.screenshot is not None:
+            painter.drawImage(0, 0, self._tile(idx, size))
+        if state in TILE_TINTS:
+            painter.fillRect(pixmap.rect(), TILE_TINTS[state])
+        # Quadrants are framed, so that neighbouring tiles of a uniform screen can be told apart
+        painter.setPen(QColor(Qt.gray))
+        painter.drawRect(pixmap.rect().adjusted(0, 0, -1, -1))
+        painter.end()
+        return pixmap
+
+    def _tile(self, idx, size):
+        if idx not in self._tiles:
+            pixels = self.screenshot.tile(*self.targeting.quadrant(idx), size.width(), size.height())
+            height, width = pixels.shape[:2]
+            data = pixels.tobytes()
+            image = QImage(data, width, height, 3 * width, QImage.Format_RGB888)
+            # Scaling copies the pixels, so the image no longer refers to the buffer afterwards
+            self._tiles[idx] = image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        return self._tiles[idx]
+
+
+class QualityUI(QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._channels = []
+
+        self.setWindowTitle("Signal quality")
+        self.setGeometry(0, 600, 600, 100)
+
+    def set_quality(self, channels):
+        # Reports arrive every few seconds, so the whole widget is simply repainted
+        self._channels = channels
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.black)
+        if self._channels:
+            width = self.width() / len(self._channels)
+            for i, (status, noise, line_noise, peak_to_peak) in enumerate(self._channels):
+                name, color = CHANNEL_STATUSES[status] if status < len(CHANNEL_STATUSES) else ("?", Qt.gray)
+                rect = QRect(int(i * width), 0, int(width) - 2, self.height())
+                painter.fillRect(rect, color)
+                painter.setPen(QColor(Qt.white))
+                channel = CHANNEL_NAMES[i] if i < len(CHANNEL_NAMES) else str(i)
+                painter.drawText(rect, Qt.AlignHCenter | Qt.AlignVCenter,
+                                 "{}\n{}\n{:.0f} uV".format(channel, name, noise))
+        painter.end()
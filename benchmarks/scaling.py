@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import model
+import run_session
+from realtime import Workers
+from realtime.simulation import CyKitSimulator, FakeInteractionApp
+
+METRICS = ['batch_latency', 'segment_delay', 'flash_ack', 'model_scoring', 'loop_stall']
+
+
+async def run(num_sessions, args, session_argv, cpu):
+    simulators = [await CyKitSimulator(p300_amplitude=args.p300_amplitude).start() for _ in range(num_sessions)]
+    # A couple of training iterations first, so that the sessions also score
+    apps = [await FakeInteractionApp(simulator, num_train=2, num_work=10 ** 6).start() for simulator in simulators]
+    sessions = []
+    for i, (simulator, app) in enumerate(zip(simulators, apps)):
+        session_args = run_session.parse_args(
+            ['localhost', str(simulator.port), str(app.port)] + session_argv + ['--profile', 'headset-{}'.format(i)])
+        sessions.append(run_session.create_session(session_args, Workers(cpu=cpu)))
+
+    tasks = [asyncio.ensure_future(session.run()) for session in sessions]
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        await asyncio.wait(tasks, timeout=args.duration)
+    finally:
+        cpu_load = (time.process_time() - start_cpu) / (time.perf_counter() - start_wall)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for session in sessions:
+            session.stop()
+        for app, simulator in zip(apps, simulators):
+            app.stop()
+            simulator.stop()
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+    row = [num_sessions, cpu_load * 100.0]
+    for name in METRICS:
+        histograms = [s.metrics.histograms[name] for s in sessions if name in s.metrics.histograms]
+        values = np.concatenate([np.fromiter(h._values, dtype=np.float64) for h in histograms]) if histograms else []
+        row.append(np.percentile(values, 95) * 1000.0 if len(values) else float('nan'))
+    row.append(sum(len(app.selections) for app in apps))
+    return row
+
+
+def main():
+    args, session_argv = parse_args()
+    session_argv = [x for x in session_argv if x != '--']
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    print("CPU is the share of one core used by this process, including the simulated headsets and apps. "
+          "Latencies are p95 over all sessions, in ms")
+    print(("{:>8} {:>7}" + " {:>14}" * len(METRICS) + " {:>10}").format("sessions", "cpu %", *METRICS, "selections"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        model.CONFIG_DIRECTORY = Path(directory)
+        cpu = ProcessPoolExecutor(max_workers=args.processes) if args.processes > 0 else None
+        try:
+            for num_sessions in args.sessions:
+                row = asyncio.get_event_loop().run_until_complete(run(num_sessions, args, session_argv, cpu))
+                print(("{:>8} {:>7.1f}" + " {:>14.1f}" * len(METRICS) + " {:>10}").format(*row))
+        finally:
+            if cpu is not None:
+                cpu.shutdown()
+
+    if resource is not None:
+        print("Peak RSS: {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Measures CPU load and latency of several sessions sharing one process. '
+                                        'Unknown arguments are passed to every session (see run_session.py)')
+    parser.add_argument('--sessions', help='Numbers of simultaneous sessions to measure', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--duration', help='Seconds to run each configuration for', type=float, default=20.0)
+    parser.add_argument('--processes', help='Size of the shared process pool for model and ICA fitting',
+                        type=int, default=0)
+    parser.add_argument('--p300-amplitude', help='Amplitude of the injected P300 response',
+                        type=float, default=5.0)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    main()
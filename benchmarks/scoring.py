@@ -0,0 +1,72 @@
+import random
+import timeit
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import numpy as np
+
+from model import average_segments, make_classifier
+
+LAYOUTS = {
+    'keyboard': [('row', i) for i in range(6)] + [('col', i) for i in range(6)],
+    'mouse': list(range(5)),
+}
+
+
+def average_segments_per_stimulus(stimuli, segments):
+    d = defaultdict(list)
+    for stimulus, segment in zip(stimuli, segments):
+        d[stimulus].append(segment[1])
+    return {k: np.mean(np.array(v), axis=0) for k, v in d.items()}
+
+
+def score_per_stimulus(clf, stimuli, segments):
+    probs = {}
+    for stimulus, x in average_segments_per_stimulus(stimuli, segments).items():
+        probs[stimulus] = clf.predict_proba([x])[0, 1]
+    return probs
+
+
+def score_vectorized(clf, stimuli, segments):
+    keys, X = average_segments(stimuli, segments)
+    return dict(zip(keys, clf.predict_proba(X)[:, 1]))
+
+
+def make_iteration(layout, num_repetitions, segment_duration, channels=14):
+    stimuli = layout * num_repetitions
+    random.shuffle(stimuli)
+    segments = [(i, np.random.randn(segment_duration, channels).astype(np.float32))
+                for i in range(len(stimuli))]
+    return stimuli, segments
+
+
+def main():
+    args = parse_args()
+
+    for name, layout in LAYOUTS.items():
+        clf = make_classifier()
+        X = np.random.randn(10 * len(layout), args.segment_duration, 14)
+        y = np.arange(len(X)) % len(layout) == 0
+        clf.fit(X, y)
+
+        stimuli, segments = make_iteration(layout, args.num_repetitions, args.segment_duration)
+        reference = score_per_stimulus(clf, stimuli, segments)
+        result = score_vectorized(clf, stimuli, segments)
+        assert all(np.isclose(reference[k], result[k], atol=1e-5) for k in layout)
+
+        for label, fn in (('per-stimulus', score_per_stimulus), ('vectorized', score_vectorized)):
+            times = timeit.repeat(lambda: fn(clf, stimuli, segments), number=args.number, repeat=args.repeat)
+            print("{:<8} {:<12} {:8.3f} ms".format(name, label, min(times) / args.number * 1000.0))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Compare per-stimulus and vectorized LDA scoring')
+    parser.add_argument('--num-repetitions', type=int, default=5)
+    parser.add_argument('--segment-duration', type=int, default=128)
+    parser.add_argument('--number', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
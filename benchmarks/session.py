@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import math
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+import model
+import run_session
+from realtime import Session, Workers
+from realtime.session import LETTERS, NUM_MOUSE_CLASSES
+from realtime.simulation import CyKitSimulator, FakeInteractionApp
+
+
+class Timings:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, name, value):
+        self.values.setdefault(name, []).append(value)
+
+    def wrap(self, name, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def wrap_async(self, name, fn):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def report(self):
+        print("{:<32} {:>6} {:>10} {:>10} {:>10}".format("stage", "n", "p50 ms", "p95 ms", "max ms"))
+        for name, values in self.values.items():
+            ms = np.array(values) * 1000.0
+            print("{:<32} {:>6} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name, len(ms), np.percentile(ms, 50), np.percentile(ms, 95), ms.max()))
+
+
+def bits_per_selection(num_classes, accuracy):
+    if accuracy <= 1.0 / num_classes:
+        return 0.0
+    bits = math.log2(num_classes) + accuracy * math.log2(accuracy)
+    if accuracy < 1.0:
+        bits += (1.0 - accuracy) * math.log2((1.0 - accuracy) / (num_classes - 1))
+    return bits
+
+
+async def run(args, session_argv):
+    simulator = await CyKitSimulator(p300_amplitude=args.p300_amplitude, blink_rate=args.blink_rate).start()
+    text = args.text.read_text(encoding='utf-8', errors='ignore') if args.text is not None else None
+    app = FakeInteractionApp(simulator, args.train, args.select, args.mode, text=text)
+    if args.unix_socket:
+        path = str(model.CONFIG_DIRECTORY / 'interaction.sock')
+        await app.start(path=path)
+        session_argv = session_argv + ['--interaction-socket', path]
+    else:
+        await app.start()
+    session_args = run_session.parse_args(['localhost', str(simulator.port), str(app.port or 0)] + session_argv)
+
+    timings = Timings()
+    workers = Workers(processes=session_args.processes)
+    strategy = run_session.create_preprocessing_strategy(session_args, workers)
+    strategy.preprocess_batch = timings.wrap('preprocessing per batch', strategy.preprocess_batch)
+    session_model = run_session.create_model(session_args, workers)
+    session_model.get_probabilities = timings.wrap('classification', session_model.get_probabilities)
+
+    session = Session(session_args, strategy, session_model, workers, run_session.create_prior(session_args))
+    # Segments are awaited right after the flash signal is sent
+    session._wait_for_segment = timings.wrap_async('flash to segment', session._wait_for_segment)
+
+    task = asyncio.ensure_future(session.run())
+    try:
+        await asyncio.wait([task, asyncio.ensure_future(app.finished.wait())],
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # Let signals that are still in flight reach the app before disconnecting
+        await asyncio.sleep(0.1)
+        session.stop()
+        app.stop()
+        simulator.stop()
+        workers.shutdown()
+    if not task.cancelled() and task.exception() is not None:
+        raise task.exception()
+
+    print("Simulated {} training and {} working iterations".format(args.train, len(app.selections)))
+    timings.report()
+    print(session.metrics.summary())
+
+    if app.selections:
+        correct = [c for c, _ in app.selections]
+        durations = [d for _, d in app.selections]
+        accuracy = sum(correct) / len(correct)
+        num_classes = len(''.join(LETTERS)) if args.mode == 'keyboard' else NUM_MOUSE_CLASSES
+        bits = bits_per_selection(num_classes, accuracy)
+        print("Accuracy: {:.3f}, mean selection time: {:.2f} s, throughput: {:.2f} bits/min".format(
+            accuracy, np.mean(durations), bits * 60.0 / np.mean(durations)))
+
+
+def main():
+    args, session_argv = parse_args()
+    session_argv = [x for x in session_argv if x != '--']
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        model.CONFIG_DIRECTORY = Path(directory)
+        asyncio.get_event_loop().run_until_complete(run(args, session_argv))
+
+
+def parse_args():
+    parser = ArgumentParser(description='End-to-end session benchmark against a simulated headset and app. '
+                                        'Unknown arguments are passed to the session (see run_session.py)')
+    parser.add_argument('--mode', choices=['keyboard', 'mouse'], default='keyboard')
+    parser.add_argument('--train', help='Number of training iterations', type=int, default=5)
+    parser.add_argument('--select', help='Number of working iterations', type=int, default=5)
+    parser.add_argument('--p300-amplitude', help='Amplitude of the injected P300 response',
+                        type=float, default=5.0)
+    parser.add_argument('--blink-rate', help='Average number of simulated blinks per second',
+                        type=float, default=0.0)
+    parser.add_argument('--text', help='Text file the simulated user types in working mode '
+                        '(random letters by default)', type=Path, default=None)
+    parser.add_argument('--unix-socket', help='Talk to the app over a Unix domain socket', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+from realtime.simulation import CyKitSimulator, FakeInteractionApp
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def measure_import_time():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import run_session'], cwd=str(ROOT), check=True)
+    return time.perf_counter() - start
+
+
+async def wait_until(predicate, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Session did not respond in time")
+        await asyncio.sleep(0.001)
+
+
+async def run(args):
+    simulator = await CyKitSimulator().start()
+    # Training iterations need no trained model, so the app stays in training mode
+    app = await FakeInteractionApp(simulator, num_train=10 ** 6, active=False).start()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        process = await asyncio.create_subprocess_exec(
+            # No highlight before training iterations, so that the first flash follows the switch right away
+            sys.executable, 'run_session.py', 'localhost', str(simulator.port), str(app.port), '0.3', '5', '0',
+            '--no-plot',
+            cwd=str(ROOT), env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+
+        try:
+            await wait_until(lambda: app.config_times)
+            cold_start = app.config_times[0] - start
+
+            switch_times = []
+            for _ in range(args.switches):
+                num_flashes, num_requests = len(app.flash_times), len(app.config_times)
+                switched_at = loop.time()
+                app.set_active(True)
+                await wait_until(lambda: len(app.flash_times) > num_flashes)
+                switch_times.append(app.flash_times[num_flashes] - switched_at)
+
+                await asyncio.sleep(args.active_time)
+                app.set_active(False)
+                await wait_until(lambda: len(app.config_times) > num_requests + 1)
+        finally:
+            process.terminate()
+            await process.wait()
+            app.stop()
+            simulator.stop()
+
+    print("Import of run_session: {:.3f} s".format(measure_import_time()))
+    print("Cold start (process start to first config request): {:.3f} s".format(cold_start))
+    switch_ms = np.array(switch_times) * 1000.0
+    print("Warm switch to active (mode push to first flash): n={} p50={:.1f}ms max={:.1f}ms".format(
+        len(switch_ms), np.percentile(switch_ms, 50), switch_ms.max()))
+
+
+def main():
+    args = parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Measures how long the session takes to start, and to start '
+                                        'flashing once a running session is switched on by the app')
+    parser.add_argument('--switches', help='Number of times the session is switched on and off',
+                        type=int, default=5)
+    parser.add_argument('--active-time', help='Seconds the session stays on after each switch',
+                        type=float, default=1.0)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
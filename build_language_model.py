@@ -0,0 +1,30 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+import model
+from model import NgramPrior
+from realtime.session import LETTERS
+
+
+def main():
+    args = parse_args()
+
+    text = '\n'.join(path.read_text(encoding='utf-8', errors='ignore') for path in args.corpus)
+    prior = NgramPrior.from_text(''.join(LETTERS), text, args.order)
+    output = args.output or model.CONFIG_DIRECTORY / "language_model.txt"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    prior.save(output)
+    print("Saved a {}-gram model to {}".format(prior.order, output))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Count character n-grams of a text corpus for the keyboard language model')
+    parser.add_argument('corpus', help='Text files to count n-grams in', type=Path, nargs='+')
+    parser.add_argument('--order', help='Length of the longest n-gram', type=int, default=3)
+    parser.add_argument('--output', help='File to save the counts to (~/.bci/language_model.txt by default)',
+                        type=Path, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+import model
+from model import convert_json_dump
+
+
+def main():
+    args = parse_args()
+
+    paths = args.paths or sorted((model.CONFIG_DIRECTORY / "data").glob("*.txt"))
+    for path in paths:
+        directory = path.with_suffix('')
+        if directory.exists():
+            print("Skipping {}: {} already exists".format(path, directory))
+            continue
+        convert_json_dump(path, directory)
+        print("Converted {} to {}".format(path, directory))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Convert JSON iteration dumps to the binary recording format')
+    parser.add_argument('paths', help='JSON dumps to convert (defaults to all dumps in the data directory)',
+                        type=Path, nargs='*')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
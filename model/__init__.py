@@ -1,6 +1,10 @@
 from pathlib import Path
 
+from model.features import *
+from model.language import *
 from model.model import *
+from model.online import *
 from model.preprocessing import *
+from model.recording import *
 
 CONFIG_DIRECTORY = Path.home() / ".bci"
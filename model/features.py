@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class FeatureExtractor:
+    # Follows the sklearn transformer interface without importing sklearn, so it can lead a pipeline
+    def __init__(self, sample_rate=128, window=(200, 600), decimation=4, channels=None, xdawn_filters=0,
+                 regularization=1e-6):
+        self.sample_rate = sample_rate
+        self.window = window
+        self.decimation = decimation
+        self.channels = channels
+        self.xdawn_filters = xdawn_filters
+        self.regularization = regularization
+
+    def get_params(self, deep=True):
+        return {
+            'sample_rate': self.sample_rate,
+            'window': self.window,
+            'decimation': self.decimation,
+            'channels': self.channels,
+            'xdawn_filters': self.xdawn_filters,
+            'regularization': self.regularization,
+        }
+
+    def set_params(self, **params):
+        for name, value in params.items():
+            setattr(self, name, value)
+        return self
+
+    def fit(self, X, y=None):
+        self.filters_ = None
+        if self.xdawn_filters:
+            self.filters_ = self._fit_xdawn(self._select(X), np.asarray(y))
+        return self
+
+    def transform(self, X):
+        epochs = self._select(X)
+        if getattr(self, 'filters_', None) is not None:
+            epochs = epochs @ self.filters_
+        return epochs.reshape(len(epochs), -1)
+
+    def fit_transform(self, X, y=None):
+        return self.fit(X, y).transform(X)
+
+    def _select(self, X):
+        epochs = np.asarray(X)
+        if self.channels is not None:
+            epochs = epochs[:, :, self.channels]
+        if self.window is not None:
+            start, stop = (int(round(t * self.sample_rate / 1000.0)) for t in self.window)
+            epochs = epochs[:, start:stop]
+
+        # Averaging blocks of samples low-passes the epochs before they are decimated
+        k = self.decimation
+        if k > 1:
+            n = epochs.shape[1] // k
+            epochs = epochs[:, :n * k].reshape(len(epochs), n, k, -1).mean(axis=2)
+        return epochs
+
+    def _fit_xdawn(self, epochs, y):
+        import scipy.linalg
+
+        # Spatial filters that maximize the power of the target response relative to the whole signal
+        evoked = epochs[y == 1].mean(axis=0)
+        evoked_cov = np.cov(evoked, rowvar=False)
+        signal_cov = np.cov(epochs.reshape(-1, epochs.shape[2]), rowvar=False)
+        signal_cov[np.diag_indices_from(signal_cov)] += self.regularization * np.trace(signal_cov)
+        _, vectors = scipy.linalg.eigh(evoked_cov, signal_cov)
+        return vectors[:, ::-1][:, :self.xdawn_filters]
@@ -0,0 +1,92 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+
+class SymbolPrior(ABC):
+    def __init__(self, symbols):
+        self.symbols = symbols
+
+    @abstractmethod
+    def log_probabilities(self, context):
+        # Log probabilities of every symbol (in the order of self.symbols) following the context
+        pass
+
+
+class UniformPrior(SymbolPrior):
+    def log_probabilities(self, context):
+        return np.full(len(self.symbols), -np.log(len(self.symbols)))
+
+
+class NgramPrior(SymbolPrior):
+    def __init__(self, symbols, counts, cache_size=4096):
+        super().__init__(symbols)
+        self.order = max(map(len, counts), default=1)
+
+        # Counts of the symbols following each context, from which Witten-Bell estimates are built
+        self._index = {s: i for i, s in enumerate(symbols)}
+        self._followers = {}
+        for ngram, count in counts.items():
+            if ngram[-1] in self._index:
+                followers = self._followers.setdefault(ngram[:-1], np.zeros(len(symbols)))
+                followers[self._index[ngram[-1]]] += count
+        self._probabilities = lru_cache(maxsize=cache_size)(self._probabilities)
+
+    @classmethod
+    def from_text(cls, symbols, text, order=3):
+        counts = Counter()
+        for word in _split(symbols, text):
+            for n in range(1, order + 1):
+                counts.update(word[i:i + n] for i in range(len(word) - n + 1))
+        return cls(symbols, counts)
+
+    @classmethod
+    def load(cls, symbols, path, **kwargs):
+        counts = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                ngram, count = line.split()
+                counts[ngram] = int(count)
+        return cls(symbols, counts, **kwargs)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for context, followers in sorted(self._followers.items()):
+                for i in np.flatnonzero(followers):
+                    f.write("{}{} {}\n".format(context, self.symbols[i], int(followers[i])))
+
+    def log_probabilities(self, context):
+        # Only the last order - 1 symbols matter, and anything not on the keyboard breaks the context
+        history = []
+        for c in reversed(context.upper()):
+            if len(history) == self.order - 1 or c not in self._index:
+                break
+            history.append(c)
+        return np.log(self._probabilities(''.join(reversed(history))))
+
+    def _probabilities(self, context):
+        if context:
+            lower = self._probabilities(context[1:])
+        else:
+            lower = np.full(len(self.symbols), 1.0 / len(self.symbols))
+
+        followers = self._followers.get(context)
+        if followers is None:
+            return lower
+        distinct = np.count_nonzero(followers)
+        return (followers + distinct * lower) / (followers.sum() + distinct)
+
+
+def _split(symbols, text):
+    words, word = [], []
+    for c in text.upper():
+        if c in symbols:
+            word.append(c)
+        elif word:
+            words.append(''.join(word))
+            word = []
+    if word:
+        words.append(''.join(word))
+    return words
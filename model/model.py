@@ -1,51 +1,224 @@
-import json
+import bisect
+import itertools
+import logging
 from abc import ABC, abstractmethod
-from collections import defaultdict
 from datetime import datetime
 
 import joblib
 import numpy as np
-from matplotlib.figure import Figure
-from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-from sklearn.pipeline import make_pipeline
-from sklearn.preprocessing import StandardScaler
 
 import model
+from model.features import FeatureExtractor
+from model.online import OnlineLDA
+from model.recording import RecordWriter, SessionRecorder
+
+logger = logging.getLogger(__name__)
 
 
 def average_segments(stimuli, segments):
-    d = defaultdict(list)
-    for stimulus, segment in zip(stimuli, segments):
-        d[stimulus].append(segment[1])
-    return {k: np.mean(np.array(v), axis=0).flatten() for k, v in d.items()}
+    keys = list(dict.fromkeys(stimuli))
+    index = {k: i for i, k in enumerate(keys)}
+    groups = np.fromiter((index[x] for x in stimuli), dtype=np.intp, count=len(stimuli))
+
+    # Grouped mean as a single product of a (keys, flashes) weight matrix and the stacked epochs
+    data = np.stack([segment[1] for segment in segments])
+    weights = np.zeros((len(keys), len(stimuli)))
+    weights[groups, np.arange(len(stimuli))] = 1.0
+    weights /= weights.sum(axis=1, keepdims=True)
+    return keys, (weights @ data.reshape(len(stimuli), -1)).reshape((len(keys),) + data.shape[1:])
+
+
+class EpochAccumulator:
+    def __init__(self, keep_segments=False):
+        self.stimuli = []
+        self.events = []
+        # Flash epochs themselves are only kept when something needs them, e.g. for plotting
+        self.segments = [] if keep_segments else None
+
+        self._index = {}
+        self._sums = []
+        self._counts = []
+        # Repetitions with artifacts are summed separately and only used where no clean one exists
+        self._rejected_sums = []
+        self._rejected_counts = []
+
+    def __len__(self):
+        return len(self.stimuli)
+
+    @property
+    def rejected(self):
+        return sum(self._rejected_counts)
+
+    def add(self, stimulus, start, data, clean=True):
+        # Segments may complete out of order once they are re-anchored, but onsets follow the flash order,
+        # so sorting by start keeps stimuli and events in the order of the flashes
+        position = bisect.bisect_right(self.events, (start, len(data)))
+        self.stimuli.insert(position, stimulus)
+        self.events.insert(position, (start, len(data)))
+        if self.segments is not None:
+            # Epochs may be views into the preprocessing buffer, which is overwritten later on
+            self.segments.insert(position, (start, np.array(data)))
+
+        i = self._index.setdefault(stimulus, len(self._sums))
+        if i == len(self._sums):
+            for sums, counts in ((self._sums, self._counts), (self._rejected_sums, self._rejected_counts)):
+                sums.append(np.zeros(np.shape(data)))
+                counts.append(0)
+        sums, counts = (self._sums, self._counts) if clean else (self._rejected_sums, self._rejected_counts)
+        sums[i] += data
+        counts[i] += 1
+
+    def average(self):
+        counts = np.array(self._counts)
+        rejected = counts == 0
+        sums = np.where(rejected[:, None, None], np.stack(self._rejected_sums), np.stack(self._sums))
+        counts = np.where(rejected, self._rejected_counts, counts)
+        return list(self._index), sums / counts[:, None, None]
+
+    def copy(self):
+        other = EpochAccumulator()
+        other.stimuli, other.events = list(self.stimuli), list(self.events)
+        other._index, other._counts = dict(self._index), list(self._counts)
+        other._sums = [s.copy() for s in self._sums]
+        other._rejected_counts = list(self._rejected_counts)
+        other._rejected_sums = [s.copy() for s in self._rejected_sums]
+        return other
+
+
+def fit_classifier(clf, X, y):
+    # Returns the fitted classifier, as it comes back as a copy when fitted in another process
+    return clf.fit(X, y)
+
+
+def make_classifier(extractor=None):
+    # sklearn takes about a second to import, which is only paid once a classifier is needed
+    from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    return make_pipeline(
+        extractor if extractor is not None else FeatureExtractor(),
+        StandardScaler(),
+        LinearDiscriminantAnalysis()
+    )
 
 
 class Model(ABC):
+    # Whether the epochs passed in should keep every flash epoch, not just their per-stimulus sums
+    needs_segments = False
+
     @abstractmethod
-    def train_iteration(self, stimuli, segments, target):
+    def train_iteration(self, epochs, target):
         raise NotImplementedError
 
     @abstractmethod
-    def get_probabilities(self, stimuli, segments):
+    def get_probabilities(self, epochs):
         raise NotImplementedError
 
+    def score(self, epochs):
+        return self.get_probabilities(epochs)
+
+    def start_recording(self):
+        pass
+
+    def record_signal(self, start, raw, preprocessed):
+        pass
+
+    def close(self):
+        pass
+
 
 class RecordModel(Model):
     SCALE_FACTOR = 4.0
 
-    def train_iteration(self, stimuli, segments, target):
-        filename = "train_" + self._get_timestamp()
-        self._plot(filename, stimuli, segments, target)
-        self._dump(filename, {"stimuli": stimuli, "segments": segments, "target": target})
+    def __init__(self, plot=True, max_pending=256, block=False, directory=None):
+        self.plot = plot
+        # Recordings, plots and model files of this user live here
+        self.directory = directory if directory is not None else model.CONFIG_DIRECTORY
+        self._writer = RecordWriter(max_pending, block)
+        # Plots are slow to render, so at most a couple are queued and the rest are dropped
+        self._plot_writer = RecordWriter(max_pending=2) if plot else None
+        self._recorder = None
+        self._recording_name = self._get_timestamp()
+        # Sample the recording starts at, which is written as its sample 0
+        self._origin = None
+        self._iteration = 0
+
+    @property
+    def needs_segments(self):
+        return self.plot
+
+    def start_recording(self):
+        # Every active period of a long-running session goes to a recording of its own, so that the idle
+        # time in between doesn't leave zero-filled gaps in the signal files
+        self._origin = None
+        self._iteration = 0
+        self._writer.submit(self._switch_recording, self._get_timestamp())
+
+    def record_signal(self, start, raw, preprocessed):
+        if self._origin is None:
+            self._origin = start
+        self._writer.submit(self._write_signal, start - self._origin, raw, preprocessed)
+
+    def train_iteration(self, epochs, target):
+        self._record("train_" + self._get_timestamp(), epochs, target)
+
+    def get_probabilities(self, epochs):
+        self._record("work_" + self._get_timestamp(), epochs, None)
+        return self.score(epochs)
+
+    def score(self, epochs):
+        return {x: 0.0 for x in epochs.stimuli}
 
-    def get_probabilities(self, stimuli, segments):
-        filename = "work_" + self._get_timestamp()
-        self._plot(filename, stimuli, segments, [])
-        self._dump(filename, {"stimuli": stimuli, "segments": segments})
-        return {x: 0.0 for x in stimuli}
+    def close(self):
+        if self._plot_writer is not None:
+            self._plot_writer.close()
+        self._writer.close()
+        if self._recorder is not None:
+            self._recorder.close()
+
+    def _record(self, filename, epochs, target):
+        stimuli = list(epochs.stimuli)
+        origin = self._origin or 0
+        events = [(start - origin, duration) for start, duration in epochs.events]
+        self._writer.submit(self._write_events, self._iteration, stimuli, events, target)
+        self._iteration += 1
+
+        if self._plot_writer is not None and epochs.segments is not None:
+            self._plot_writer.submit(self._plot, self.directory / "images", filename, stimuli,
+                                     list(epochs.segments), target or [])
+
+    def _write_signal(self, start, raw, preprocessed):
+        recorder = self._get_recorder()
+        recorder.write_signal('raw', start, raw)
+        recorder.write_signal('preprocessed', start, preprocessed)
+
+    def _write_events(self, iteration, stimuli, events, target):
+        recorder = self._get_recorder()
+        recorder.write_events(iteration, stimuli, events, target)
+        recorder.flush()
+
+    def _switch_recording(self, name):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        self._recording_name = name
+
+    def _get_recorder(self):
+        if self._recorder is None:
+            # Recordings started within the same second get a suffix instead of overwriting each other
+            directory = self.directory / "data" / self._recording_name
+            for i in itertools.count(1):
+                if not directory.exists():
+                    break
+                directory = directory.with_name("{}_{}".format(self._recording_name, i))
+            self._recorder = SessionRecorder(directory)
+        return self._recorder
 
     @staticmethod
-    def _plot(filename, stimuli, segments, target):
+    def _plot(directory, filename, stimuli, segments, target):
+        from matplotlib.figure import Figure
+
         rows, cols = RecordModel._get_rows_cols(len(stimuli))
         fig = Figure(figsize=(RecordModel.SCALE_FACTOR * cols, RecordModel.SCALE_FACTOR * rows))
         axs = fig.subplots(rows, cols)
@@ -60,18 +233,9 @@ class RecordModel(Model):
             axs[row, col].set_title(caption)
             axs[row, col].plot(data)
 
-        directory = model.CONFIG_DIRECTORY / "images"
         directory.mkdir(parents=True, exist_ok=True)
         fig.savefig(directory / "{}.png".format(filename))
 
-    @staticmethod
-    def _dump(filename, data):
-        directory = model.CONFIG_DIRECTORY / "data"
-        directory.mkdir(parents=True, exist_ok=True)
-        path = directory / "{}.txt".format(filename)
-        with open(path, 'w') as f:
-            json.dump(data, f)
-
     @staticmethod
     def _get_timestamp():
         return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -87,37 +251,90 @@ class RecordModel(Model):
 
 
 class LDAModel(RecordModel):
-    def __init__(self):
-        directory = model.CONFIG_DIRECTORY / "models"
+    FILENAME = "lda_model.joblib"
+
+    def __init__(self, extractor=None, fit_executor=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fit_executor = fit_executor
+
+        directory = self.directory / "models"
         directory.mkdir(parents=True, exist_ok=True)
-        self.filename = directory / "lda_model.joblib"
+        self.filename = directory / self.FILENAME
 
         if self.filename.exists():
             self._clf = joblib.load(self.filename)
+            # Models saved before feature extraction was part of the pipeline take whole flattened epochs
+            if not isinstance(self._clf.steps[0][1], FeatureExtractor):
+                self._clf.steps.insert(0, ('featureextractor', FeatureExtractor(window=None, decimation=1)))
         else:
-            self._clf = make_pipeline(
-                StandardScaler(),
-                LinearDiscriminantAnalysis()
-            )
+            self._clf = make_classifier(extractor)
 
         self._X, self._y = [], []
 
-    def train_iteration(self, stimuli, segments, target):
-        super().train_iteration(stimuli, segments, target)
-
-        for stimulus, x in average_segments(stimuli, segments).items():
-            self._X.append(x)
-            self._y.append(int(stimulus in target))
+    def train_iteration(self, epochs, target):
+        super().train_iteration(epochs, target)
 
-    def get_probabilities(self, stimuli, segments):
-        parent_proba = super().get_probabilities(stimuli, segments)
+        keys, X = epochs.average()
+        self._X.extend(X)
+        self._y.extend(int(stimulus in target) for stimulus in keys)
 
+    def score(self, epochs):
         if self._X:
-            self._clf.fit(self._X, self._y)
+            if self.fit_executor is not None:
+                self._clf = self.fit_executor.submit(fit_classifier, self._clf, self._X, self._y).result()
+            else:
+                self._clf = fit_classifier(self._clf, self._X, self._y)
             joblib.dump(self._clf, str(self.filename))
             self._X, self._y = [], []
 
-        probs = {}
-        for stimulus, x in average_segments(stimuli, segments).items():
-            probs[stimulus] = self._clf.predict_proba([x])[0, 1]
-        return probs
\ No newline at end of file
+        keys, X = epochs.average()
+        return dict(zip(keys, self._clf.predict_proba(X)[:, 1]))
+
+
+class OnlineLDAModel(RecordModel):
+    FILENAME = "lda_stats.npz"
+
+    def __init__(self, shrinkage=0.1, extractor=None, **kwargs):
+        super().__init__(**kwargs)
+        self.extractor = extractor if extractor is not None else FeatureExtractor()
+        if self.extractor.xdawn_filters:
+            raise ValueError("xDAWN filters are fitted in batch and cannot be used with the online LDA")
+
+        directory = self.directory / "models"
+        directory.mkdir(parents=True, exist_ok=True)
+        self.filename = directory / self.FILENAME
+
+        if self.filename.exists():
+            self._clf = OnlineLDA.load(self.filename)
+        else:
+            self._clf = OnlineLDA(shrinkage)
+        # Only the latest statistics matter, so saving waits for the previous save instead of queueing up
+        self._stats_writer = RecordWriter(max_pending=1, block=True)
+
+    def train_iteration(self, epochs, target):
+        super().train_iteration(epochs, target)
+
+        keys, X = epochs.average()
+        X = self._features(X)
+        self._clf.partial_fit(X, [int(stimulus in target) for stimulus in keys])
+        self._stats_writer.submit(OnlineLDA.save_state, self._clf.get_state(), self.filename)
+        # Solving here keeps the O(d^3) step off the scoring path, training is not waited for
+        if self._clf.fitted():
+            self._clf.solve()
+
+    def score(self, epochs):
+        keys, X = epochs.average()
+        X = self._features(X)
+        return dict(zip(keys, self._clf.predict_proba(X)[:, 1]))
+
+    def close(self):
+        super().close()
+        self._stats_writer.close()
+
+    def _features(self, X):
+        # Statistics saved with other feature options don't fit, whether the session trains or scores first
+        X = self.extractor.transform(X)
+        if self._clf.means is not None and self._clf.means.shape[1] != X.shape[1]:
+            logger.warning("Feature extraction has changed, discarding saved LDA statistics")
+            self._clf = OnlineLDA(self._clf.shrinkage)
+        return X
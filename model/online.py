@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+
+class OnlineLDA:
+    def __init__(self, shrinkage=0.1):
+        self.shrinkage = shrinkage
+        self.counts = np.zeros(2)
+        self.means = None
+        self.scatter = None
+
+        self._coef = None
+        self._intercept = None
+
+    def fitted(self):
+        return self.means is not None and (self.counts > 0).all()
+
+    def partial_fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        if self.means is None:
+            self.means = np.zeros((2, X.shape[1]))
+            self.scatter = np.zeros((X.shape[1], X.shape[1]))
+
+        # Welford updates of the class means and the pooled within-class scatter, O(d^2) per epoch
+        for x, c in zip(X, y):
+            self.counts[c] += 1
+            delta = x - self.means[c]
+            self.means[c] += delta / self.counts[c]
+            self.scatter += np.outer(delta, x - self.means[c])
+        self._coef = None
+        return self
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if not self.fitted():
+            return np.full((len(X), 2), 0.5)
+
+        if self._coef is None:
+            self.solve()
+        p = 1.0 / (1.0 + np.exp(-(X @ self._coef + self._intercept)))
+        return np.column_stack((1.0 - p, p))
+
+    def solve(self):
+        # Scaler moments follow from the class statistics: total variance is the within-class
+        # variance plus the spread of the class means around the global mean
+        n = self.counts.sum()
+        mean = self.counts @ self.means / n
+        variance = (np.diag(self.scatter) + self.counts @ (self.means - mean) ** 2) / n
+        scale = np.sqrt(np.where(variance > 0, variance, 1.0))
+
+        # Covariance of the standardized features, shrunk towards a multiple of the identity. Like sklearn,
+        # the class covariances are biased and weighted by the class priors, which sums to scatter / n
+        cov = self.scatter / n / np.outer(scale, scale)
+        target = np.trace(cov) / len(cov)
+        cov *= 1 - self.shrinkage
+        cov[np.diag_indices_from(cov)] += self.shrinkage * target
+
+        means = (self.means - mean) / scale
+        coef = np.linalg.solve(cov, means[1] - means[0])
+        self._coef = coef / scale
+        self._intercept = (-0.5 * coef @ (means[1] + means[0]) - self._coef @ mean
+                           + np.log(self.counts[1] / self.counts[0]))
+
+    def get_state(self):
+        return {'counts': self.counts.copy(), 'means': self.means.copy(), 'scatter': self.scatter.copy(),
+                'shrinkage': np.array(self.shrinkage)}
+
+    def set_state(self, state):
+        self.counts, self.means, self.scatter = state['counts'], state['means'], state['scatter']
+        self.shrinkage = float(state['shrinkage'])
+        self._coef = None
+
+    @staticmethod
+    def save_state(state, filename):
+        tmp_filename = filename.with_name(filename.name + '.tmp')
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **state)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        lda = cls()
+        with np.load(filename) as f:
+            lda.set_state({k: f[k] for k in f.files})
+        return lda
@@ -1,8 +1,14 @@
+import logging
+import os
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.signal
-from sklearn.decomposition import FastICA
+
+import model
+
+logger = logging.getLogger(__name__)
 
 
 class PreprocessingStrategy(ABC):
@@ -15,36 +21,176 @@ class PreprocessingStrategy(ABC):
 
 
 class ConcretePreprocessingStrategy(PreprocessingStrategy):
-    def __init__(self, bandpass_lcf=0.4, bandpass_hcf=30.0, subsample_rate=2, num_removed_comps=4):
-        super().__init__(batch_size=512)
+    def __init__(self, bandpass_lcf=0.4, bandpass_hcf=30.0, subsample_rate=2, num_removed_comps=4,
+                 batch_size=512, cached_ica=None):
+        super().__init__(batch_size=batch_size)
 
         self.bandpass_lcf = bandpass_lcf
         self.bandpass_hcf = bandpass_hcf
         self.subsample_rate = subsample_rate
         self.num_removed_comps = num_removed_comps
+        self.cached_ica = cached_ica
+
+        nyquist_freq = self.sample_rate / 2
+        self._sos = scipy.signal.butter(
+            5, [bandpass_lcf / nyquist_freq, bandpass_hcf / nyquist_freq], btype='band', output='sos')
 
     def preprocess_batch(self, batch):
         batch = np.array(batch)
 
-        res = self._bandpass(batch, self.bandpass_lcf, self.bandpass_hcf)
+        res = self._bandpass(batch)
         res = self._subsample(res, self.subsample_rate)
         res = self._ica(res, self.num_removed_comps)
 
-        return res.tolist()
-
-    def _bandpass(self, batch, lcf, hcf):
-        nyquist_freq = self.sample_rate / 2
-        b, a = scipy.signal.butter(5, [lcf / nyquist_freq, hcf / nyquist_freq], btype='band')
-        res = scipy.signal.lfilter(b, a, batch)
         return res
 
+    def _bandpass(self, batch):
+        return scipy.signal.sosfilt(self._sos, batch, axis=0)
+
     def _subsample(self, batch, k=2):
         return batch[::k].repeat(k, axis=0)
 
     def _ica(self, batch, num_comps=4):
+        if self.cached_ica is not None:
+            return self.cached_ica.transform(batch)
+
+        from sklearn.decomposition import FastICA
+
         ica = FastICA(n_components=batch.shape[1], max_iter=300)
         comps = ica.fit_transform(batch)
         m = (-np.abs(comps)).min(axis=0)
         selected = np.argsort(m)[:num_comps]
         comps[:, selected] = 0
         return ica.inverse_transform(comps)
+
+
+class StreamingPreprocessingStrategy(ConcretePreprocessingStrategy):
+    def __init__(self, chunk_size=16, **kwargs):
+        super().__init__(batch_size=chunk_size, **kwargs)
+        if chunk_size % self.subsample_rate != 0:
+            raise ValueError("Chunk size must be a multiple of the subsample rate")
+        self._zi = None
+
+    def _bandpass(self, batch):
+        # Filter state is carried over, so consecutive chunks are filtered as one continuous signal
+        if self._zi is None:
+            self._zi = np.zeros((self._sos.shape[0], 2, batch.shape[1]))
+        res, self._zi = scipy.signal.sosfilt(self._sos, batch, axis=0, zi=self._zi)
+        return res
+
+    def _ica(self, batch, num_comps=4):
+        # A single chunk is far too short to estimate independent components from,
+        # so artifact removal is only possible with a precomputed unmixing matrix
+        if self.cached_ica is None:
+            return batch
+        return super()._ica(batch, num_comps)
+
+
+class CachedICA:
+    DRIFT_CHECK_INTERVAL = 512
+
+    def __init__(self, num_removed_comps=4, calibration_size=3840, refit_interval=15360,
+                 drift_threshold=0.2, filename=None, executor=None, directory=None):
+        self.num_removed_comps = num_removed_comps
+        self.calibration_size = calibration_size
+        self.refit_interval = refit_interval
+        self.drift_threshold = drift_threshold
+
+        if filename is None:
+            directory = (directory if directory is not None else model.CONFIG_DIRECTORY) / "models"
+            directory.mkdir(parents=True, exist_ok=True)
+            filename = directory / "ica_unmixing.npz"
+        self.filename = filename
+
+        self._window = None
+        self._since_fit = 0
+        self._since_check = 0
+        self._params = None
+        self._refit = None
+        # Fits only depend on their arguments, so they can also run in a process pool
+        self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+
+        if self.filename.exists():
+            with np.load(self.filename) as f:
+                self._params = {k: f[k] for k in f.files}
+
+    def transform(self, batch):
+        self._append_to_window(batch)
+        self._collect_refit()
+
+        if self._params is None:
+            # The first fit runs in the background like any refit, batches pass through unchanged until it is done
+            if self._refit is None and len(self._window) >= self.calibration_size:
+                self._since_fit = 0
+                self._refit = self._executor.submit(
+                    self._fit, self._window.copy(), None, self.num_removed_comps, self.filename)
+            return batch
+        if self._refit is None and self._needs_refit():
+            self._since_fit = 0
+            self._refit = self._executor.submit(
+                self._fit, self._window.copy(), self._params['unmixing'], self.num_removed_comps, self.filename)
+
+        return batch @ self._params['projection'] + self._params['offset']
+
+    def drift(self):
+        # Sources estimated with a still-valid unmixing matrix stay mutually uncorrelated
+        sources = (self._window - self._params['mean']) @ self._params['components'].T
+        corr = np.corrcoef(sources, rowvar=False)
+        off_diagonal = corr[~np.eye(len(corr), dtype=bool)]
+        return np.abs(off_diagonal).mean()
+
+    def _append_to_window(self, batch):
+        if self._window is None:
+            self._window = np.empty((0, batch.shape[1]))
+        self._window = np.concatenate((self._window, batch))[-self.calibration_size:]
+        self._since_fit += len(batch)
+        self._since_check += len(batch)
+
+    def _needs_refit(self):
+        if self._since_fit >= self.refit_interval:
+            return True
+        if self._since_check < self.DRIFT_CHECK_INTERVAL:
+            return False
+
+        self._since_check = 0
+        drift = self.drift()
+        logger.debug("ICA drift: %.4f", drift)
+        return drift > self.drift_threshold
+
+    def _collect_refit(self):
+        if self._refit is None or not self._refit.done():
+            return
+        try:
+            self._params = self._refit.result()
+        except Exception:
+            logger.exception("ICA fit failed, keeping the previous unmixing matrix (if any)")
+        self._refit = None
+
+    @staticmethod
+    def _fit(window, w_init, num_comps, filename):
+        from sklearn.decomposition import FastICA
+
+        ica = FastICA(n_components=window.shape[1], max_iter=300, w_init=w_init)
+        comps = ica.fit_transform(window)
+        m = (-np.abs(comps)).min(axis=0)
+        selected = np.argsort(m)[:num_comps]
+
+        # Unmixing, zeroing artifact components and remixing collapse into one linear map
+        keep = np.ones(comps.shape[1])
+        keep[selected] = 0
+        projection = (ica.components_.T * keep) @ ica.mixing_.T
+        params = {
+            'projection': projection,
+            'offset': ica.mean_ - ica.mean_ @ projection,
+            'components': ica.components_,
+            'mean': ica.mean_,
+            # Unmixing matrix in whitened space, used to warm-start the next fit
+            'unmixing': ica.components_ @ np.linalg.pinv(ica.whitening_),
+        }
+
+        tmp_filename = filename.with_name(filename.name + '.tmp')
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **params)
+        os.replace(tmp_filename, filename)
+
+        return params
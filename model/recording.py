@@ -0,0 +1,190 @@
+import json
+import logging
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class RecordWriter:
+    def __init__(self, max_pending=8, block=False):
+        self.max_pending = max_pending
+        self.block = block
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='RecordWriter', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        try:
+            self._queue.put((fn, args), block=self.block)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Recording queue is full, dropped %d item(s) so far", self.dropped)
+
+    def close(self, timeout=None):
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Recording failed")
+
+
+SIGNAL_DTYPE = np.dtype('<f4')
+EVENT_DTYPE = np.dtype([
+    ('iteration', '<i4'),
+    ('sample', '<i8'),
+    ('duration', '<i4'),
+    ('kind', 'u1'),
+    ('index', 'u1'),
+    ('target', '?'),
+    ('train', '?'),
+])
+STIMULUS_KINDS = ['class', 'row', 'col']
+
+
+def encode_stimulus(stimulus):
+    if isinstance(stimulus, (tuple, list)):
+        return STIMULUS_KINDS.index(stimulus[0]), stimulus[1]
+    return 0, stimulus
+
+
+def decode_stimulus(kind, index):
+    if kind == 0:
+        return int(index)
+    return STIMULUS_KINDS[kind], int(index)
+
+
+class SessionRecorder:
+    VERSION = 1
+
+    def __init__(self, directory, sample_rate=128):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sample_rate = sample_rate
+
+        self._signals = {}
+        self._events = open(self.directory / "events.bin", 'ab')
+        self._write_meta()
+
+    def write_signal(self, name, start, data):
+        data = np.ascontiguousarray(data, dtype=SIGNAL_DTYPE)
+        if name not in self._signals:
+            self._signals[name] = (open(self.directory / "{}.f32".format(name), 'w+b'), data.shape[1])
+            self._write_meta()
+
+        # Samples are written at their absolute position, so a dropped write leaves a gap instead of a shift
+        f, channels = self._signals[name]
+        f.seek(start * channels * SIGNAL_DTYPE.itemsize)
+        f.write(data.tobytes())
+
+    def write_events(self, iteration, stimuli, epochs, target=None):
+        events = np.zeros(len(stimuli), dtype=EVENT_DTYPE)
+        events['iteration'] = iteration
+        events['train'] = target is not None
+        events['sample'], events['duration'] = zip(*epochs)
+        events['kind'], events['index'] = zip(*map(encode_stimulus, stimuli))
+        if target is not None:
+            events['target'] = [stimulus in target for stimulus in stimuli]
+        self._events.write(events.tobytes())
+
+    def flush(self):
+        for f, _ in self._signals.values():
+            f.flush()
+        self._events.flush()
+
+    def close(self):
+        for f, _ in self._signals.values():
+            f.close()
+        self._events.close()
+
+    def _write_meta(self):
+        meta = {
+            'version': self.VERSION,
+            'sample_rate': self.sample_rate,
+            'signal_dtype': SIGNAL_DTYPE.str,
+            'signals': {name: {'channels': channels} for name, (_, channels) in self._signals.items()},
+            'event_dtype': EVENT_DTYPE.descr,
+        }
+        with open(self.directory / "meta.json", 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+class SessionReader:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json") as f:
+            self.meta = json.load(f)
+        self.sample_rate = self.meta['sample_rate']
+        self.events = np.fromfile(str(self.directory / "events.bin"), dtype=EVENT_DTYPE)
+
+    @property
+    def signals(self):
+        return list(self.meta['signals'])
+
+    def signal(self, name='preprocessed'):
+        channels = self.meta['signals'][name]['channels']
+        path = self.directory / "{}.f32".format(name)
+        num_samples = path.stat().st_size // (channels * SIGNAL_DTYPE.itemsize)
+        if num_samples == 0:
+            return np.empty((0, channels), dtype=SIGNAL_DTYPE)
+        return np.memmap(str(path), dtype=SIGNAL_DTYPE, mode='r', shape=(num_samples, channels))
+
+    def iteration_ids(self, train=None):
+        events = self.events
+        if train is not None:
+            events = events[events['train'] == train]
+        return np.unique(events['iteration'])
+
+    def epochs(self, events, name='preprocessed'):
+        # Slices of the memory map, so only the requested epochs are ever read from disk
+        signal = self.signal(name)
+        return [signal[e['sample']:(e['sample'] + e['duration'])] for e in events]
+
+    def iteration(self, iteration_id, name='preprocessed'):
+        events = self.events[self.events['iteration'] == iteration_id]
+        stimuli = [decode_stimulus(e['kind'], e['index']) for e in events]
+        segments = list(zip(events['sample'].tolist(), self.epochs(events, name)))
+        target = None
+        if events['train'].any():
+            target = list(dict.fromkeys(s for s, e in zip(stimuli, events) if e['target']))
+        return stimuli, segments, target
+
+    def iterations(self, train=None, name='preprocessed'):
+        for iteration_id in self.iteration_ids(train):
+            yield self.iteration(iteration_id, name)
+
+
+def convert_json_dump(path, directory):
+    with open(path) as f:
+        data = json.load(f)
+
+    stimuli = [tuple(x) if isinstance(x, list) else x for x in data['stimuli']]
+    segments = [(start, np.array(samples)) for start, samples in data['segments']]
+    target = data.get('target')
+    if target is not None:
+        target = [tuple(x) if isinstance(x, list) else x for x in target]
+
+    recorder = SessionRecorder(directory)
+    try:
+        # Old dumps only kept the preprocessed epochs, which overlap on the same signal
+        for start, samples in segments:
+            recorder.write_signal('preprocessed', start, samples)
+        recorder.write_events(0, stimuli, [(start, len(samples)) for start, samples in segments], target)
+    finally:
+        recorder.close()
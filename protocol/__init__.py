@@ -0,0 +1 @@
+from protocol.framing import *
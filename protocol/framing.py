@@ -0,0 +1,165 @@
+import json
+from struct import Struct
+
+__all__ = [
+    'VERSION', 'HEADER', 'FLAG_ACK', 'FLAG_PUSH', 'ProtocolError', 'FrameDecoder',
+    'REQUEST_CONFIG', 'CONFIG', 'FLASH_ACK', 'BATCH', 'SCHEDULE', 'QUALITY', 'SIGNALS',
+    'encode_frame', 'encode_batch', 'encode_json', 'decode_json',
+    'encode_signal', 'decode_signal', 'encode_flash_ack', 'decode_flash_ack',
+    'encode_schedule', 'decode_schedule', 'encode_quality', 'decode_quality', 'read_frames',
+]
+
+VERSION = 1
+# version, opcode, flags, payload length
+HEADER = Struct('<BBHI')
+FLAG_ACK = 0x1
+# Set on config frames the app sends on its own, e.g. when the user switches modes
+FLAG_PUSH = 0x2
+
+REQUEST_CONFIG = 0x01
+CONFIG = 0x02
+FLASH_ACK = 0x03
+BATCH = 0x04
+SCHEDULE = 0x05
+QUALITY = 0x06
+
+# Signals carry their arguments in fixed-width fields, letters as single ASCII bytes
+SIGNALS = {
+    'keyboard_flash_row': (0x10, Struct('<B')),
+    'keyboard_flash_col': (0x11, Struct('<B')),
+    'keyboard_highlight_letter': (0x12, Struct('<c')),
+    'keyboard_select_letter': (0x13, Struct('<c')),
+    'mouse_flash_class': (0x20, Struct('<B')),
+    'mouse_highlight_class': (0x21, Struct('<B')),
+    'mouse_select_class': (0x22, Struct('<B')),
+}
+_SIGNAL_NAMES = {opcode: (name, struct) for name, (opcode, struct) in SIGNALS.items()}
+
+ACK_ID_STRUCT = Struct('<I')
+FLASH_ACK_STRUCT = Struct('<Id')
+# flash id, signal opcode, stimulus index, onset time
+SCHEDULE_ENTRY_STRUCT = Struct('<IBBd')
+# status, noise, line noise and peak-to-peak amplitude of one channel
+CHANNEL_QUALITY_STRUCT = Struct('<Bfff')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(opcode, payload=b'', flags=0):
+    return HEADER.pack(VERSION, opcode, flags, len(payload)) + payload
+
+
+def encode_batch(frames):
+    return encode_frame(BATCH, b''.join(frames))
+
+
+def encode_json(opcode, obj, flags=0):
+    return encode_frame(opcode, json.dumps(obj).encode('utf-8'), flags)
+
+
+def decode_json(payload):
+    return json.loads(payload.decode('utf-8'))
+
+
+def encode_signal(name, *args, ack=None):
+    opcode, struct = SIGNALS[name]
+    payload = struct.pack(*(arg.encode('ascii') if isinstance(arg, str) else arg for arg in args))
+    if ack is None:
+        return encode_frame(opcode, payload)
+    return encode_frame(opcode, payload + ACK_ID_STRUCT.pack(ack), FLAG_ACK)
+
+
+def decode_signal(opcode, flags, payload):
+    if opcode not in _SIGNAL_NAMES:
+        raise ProtocolError("Unknown opcode 0x{:02x}".format(opcode))
+    name, struct = _SIGNAL_NAMES[opcode]
+    _check_length(payload, struct.size + (ACK_ID_STRUCT.size if flags & FLAG_ACK else 0))
+    args = tuple(arg.decode('ascii') if isinstance(arg, bytes) else arg
+                 for arg in struct.unpack_from(payload))
+    ack = ACK_ID_STRUCT.unpack_from(payload, struct.size)[0] if flags & FLAG_ACK else None
+    return name, args, ack
+
+
+def encode_flash_ack(flash_id, timestamp):
+    return encode_frame(FLASH_ACK, FLASH_ACK_STRUCT.pack(flash_id, timestamp))
+
+
+def decode_flash_ack(payload):
+    _check_length(payload, FLASH_ACK_STRUCT.size)
+    return FLASH_ACK_STRUCT.unpack(payload)
+
+
+def encode_schedule(entries):
+    payload = b''.join(SCHEDULE_ENTRY_STRUCT.pack(flash_id, SIGNALS[name][0], idx, onset)
+                       for flash_id, name, idx, onset in entries)
+    return encode_frame(SCHEDULE, payload)
+
+
+def decode_schedule(payload):
+    _check_length(payload, SCHEDULE_ENTRY_STRUCT.size, repeated=True)
+    entries = []
+    for flash_id, opcode, idx, onset in SCHEDULE_ENTRY_STRUCT.iter_unpack(payload):
+        if opcode not in _SIGNAL_NAMES:
+            raise ProtocolError("Unknown opcode 0x{:02x}".format(opcode))
+        entries.append((flash_id, _SIGNAL_NAMES[opcode][0], idx, onset))
+    return entries
+
+
+def encode_quality(channels):
+    return encode_frame(QUALITY, b''.join(CHANNEL_QUALITY_STRUCT.pack(*channel) for channel in channels))
+
+
+def decode_quality(payload):
+    _check_length(payload, CHANNEL_QUALITY_STRUCT.size, repeated=True)
+    return list(CHANNEL_QUALITY_STRUCT.iter_unpack(payload))
+
+
+def _check_length(payload, size, repeated=False):
+    # Malformed payloads surface as protocol errors rather than as struct errors
+    if len(payload) % size if repeated else len(payload) != size:
+        raise ProtocolError("Malformed payload of {} bytes".format(len(payload)))
+
+
+class FrameDecoder:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        # Reads may end anywhere, so incomplete frames are kept until the rest arrives
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= HEADER.size:
+            version, opcode, flags, length = HEADER.unpack_from(self._buffer, offset)
+            if version != VERSION:
+                raise ProtocolError("Unsupported protocol version {}".format(version))
+            end = offset + HEADER.size + length
+            if end > len(self._buffer):
+                break
+            _append_frame(frames, opcode, flags, bytes(self._buffer[offset + HEADER.size:end]))
+            offset = end
+        del self._buffer[:offset]
+        return frames
+
+
+def _append_frame(frames, opcode, flags, payload):
+    if opcode != BATCH:
+        frames.append((opcode, flags, payload))
+        return
+
+    # A batch is a run of complete frames, unpacked in order
+    decoder = FrameDecoder()
+    frames.extend(decoder.feed(payload))
+    if decoder._buffer:
+        raise ProtocolError("Truncated frame in batch")
+
+
+async def read_frames(reader):
+    version, opcode, flags, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version {}".format(version))
+    frames = []
+    _append_frame(frames, opcode, flags, await reader.readexactly(length))
+    return frames
@@ -0,0 +1,10 @@
+from time import perf_counter
+
+__all__ = ['now']
+
+
+def now():
+    # Timestamps are compared between the app and the session process, so both sides have to read the same
+    # system-wide clock. On Windows before Python 3.13 monotonic() only ticks every 15.6 ms, two samples
+    # at 128 Hz, while perf_counter() reads QueryPerformanceCounter (CLOCK_MONOTONIC on Linux)
+    return perf_counter()
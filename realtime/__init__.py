@@ -1 +1,2 @@
 from realtime.session import Session
+from realtime.workers import Workers
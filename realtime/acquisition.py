@@ -3,15 +3,21 @@ import logging
 from struct import Struct
 from time import time
 
+import numpy as np
+
+from protocol.timing import now
+
 
 logger = logging.getLogger(__name__)
 
 
 class CyKitClient:
     def __init__(self, reader, writer, channels=14, sample_rate=128):
+        self.channels = channels
         self.sample_rate = sample_rate
         self._reader, self._writer = reader, writer
         self._struct = Struct('>' + 'f' * channels)
+        self._pending = b''
 
     def stop(self):
         if self._writer is not None:
@@ -29,6 +35,28 @@ class CyKitClient:
 
         return self._struct.unpack(data)
 
+    async def chunks(self, max_bytes=65536):
+        while True:
+            yield await self.read_chunk(max_bytes)
+
+    async def read_chunk(self, max_bytes=65536):
+        # Returns every complete frame that is available, stamped with its arrival time
+        while True:
+            data = await self._reader.read(max_bytes)
+            timestamp = now()
+            if not data:
+                raise ConnectionError("No more data from peer")
+
+            self._pending += data
+            num_frames = len(self._pending) // self._struct.size
+            if num_frames == 0:
+                continue
+
+            size = num_frames * self._struct.size
+            frames = np.frombuffer(self._pending, dtype='>f4', count=size // 4).reshape(num_frames, self.channels)
+            self._pending = self._pending[size:]
+            return timestamp, frames.astype(np.float32)
+
     async def _initialize(self, good_packet_threshold=64):
         last_time = time()
         good_packets = 0
@@ -1,44 +1,114 @@
 import asyncio
-import json
 import logging
-from struct import Struct
 
+from protocol import (
+    CONFIG, FLAG_PUSH, FLASH_ACK, REQUEST_CONFIG, ProtocolError,
+    decode_flash_ack, decode_json, encode_batch, encode_frame, encode_quality, encode_schedule, encode_signal,
+    read_frames)
+from protocol.timing import now
 
-LENGTH_STRUCT = Struct('N')
 logger = logging.getLogger(__name__)
 
 
 class InteractionClient:
-    def __init__(self, reader, writer):
+    def __init__(self, reader, writer, metrics=None):
         self._reader, self._writer = reader, writer
+        self.metrics = metrics
+        self.on_flash_ack = None
+        self.config = None
+
+        self._config_pushed = asyncio.Event()
+        self._read_error = None
+        self._outgoing = []
+        self._queued_at = None
+        self._responses = asyncio.Queue()
+        self._read_task = asyncio.ensure_future(self._read_messages())
 
     def stop(self):
+        self._read_task.cancel()
         if self._writer is not None:
             self._writer.close()
 
     async def request_config(self):
-        return await self._request({'action': 'request_config'})
+        # Only configs pushed after this request wake up wait_for_config_push()
+        self._config_pushed.clear()
+        self.config = decode_json(await self._request(encode_frame(REQUEST_CONFIG)))
+        return self.config
+
+    async def wait_for_config_push(self):
+        await self._config_pushed.wait()
+        self._config_pushed.clear()
+        self._check_connection()
+        return self.config
+
+    async def signal(self, signal_name, *args, ack=None):
+        # With an ack id, the app replies with the time the flash was rendered at
+        self._send_frame(encode_signal(signal_name, *args, ack=ack))
+        await self._writer.drain()
 
-    async def signal(self, signal_name, *args):
-        await self._send_message({'action': 'signal', 'signal': signal_name, 'args': args})
+    async def schedule(self, entries):
+        # The app flashes (flash id, signal, index, onset) entries on its own timer and acks each actual onset
+        self._send_frame(encode_schedule(entries))
+        await self._writer.drain()
 
-    async def _send_message(self, message):
-        message_json = json.dumps(message)
-        logger.debug("Message sent: %s", message_json)
-        payload = message_json.encode('utf-8')
-        self._writer.write(LENGTH_STRUCT.pack(len(payload)) + payload)
+    async def report_quality(self, channels):
+        # (status, noise, line noise, peak-to-peak) of every channel, shown by the app next to the sensors
+        self._send_frame(encode_quality(channels))
         await self._writer.drain()
 
-    async def _read_message(self):
-        length = LENGTH_STRUCT.unpack(await self._reader.read(LENGTH_STRUCT.size))[0]
-        payload = await self._reader.read(length)
-        return json.loads(payload.decode('utf-8'))
+    def _send_frame(self, frame):
+        # Frames queued during one iteration of the event loop go out as a single batch
+        if not self._outgoing:
+            asyncio.get_event_loop().call_soon(self._flush)
+            self._queued_at = now()
+        self._outgoing.append(frame)
+
+    def _flush(self):
+        frames, self._outgoing = self._outgoing, []
+        if self._writer.is_closing():
+            return
+        self._writer.write(frames[0] if len(frames) == 1 else encode_batch(frames))
+        # From the first queued frame until the batch is handed to the socket
+        if self.metrics is not None:
+            self.metrics.observe('signal_send', now() - self._queued_at)
+
+    async def _read_messages(self):
+        try:
+            while True:
+                for opcode, flags, payload in await read_frames(self._reader):
+                    if opcode == FLASH_ACK:
+                        if self.on_flash_ack is not None:
+                            self.on_flash_ack(*decode_flash_ack(payload))
+                    elif opcode == CONFIG and flags & FLAG_PUSH:
+                        self.config = decode_json(payload)
+                        self._config_pushed.set()
+                    elif opcode == CONFIG:
+                        self._responses.put_nowait(payload)
+                    else:
+                        logger.warning("Unexpected message with opcode 0x%02x", opcode)
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError) as e:
+            # Wakes up whoever waits for a response or, while switched off, for the next config push
+            self._read_error = e
+            self._responses.put_nowait(e)
+            self._config_pushed.set()
+
+    async def _request(self, frame):
+        self._check_connection()
+        self._send_frame(frame)
+        response = await self._responses.get()
+        if isinstance(response, Exception):
+            raise ConnectionError("Connection to the app was lost") from response
+        return response
 
-    async def _request(self, message):
-        await self._send_message(message)
-        return await self._read_message()
+    def _check_connection(self):
+        if self._read_error is not None:
+            raise ConnectionError("Connection to the app was lost") from self._read_error
 
 
-async def connect_to_app(port) -> InteractionClient:
-    reader, writer = await asyncio.open_connection('localhost', port)
-    return InteractionClient(reader, writer)
+async def connect_to_app(port, metrics=None, path=None) -> InteractionClient:
+    # A Unix domain socket skips the TCP stack when the app runs on the same machine
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection('localhost', port)
+    return InteractionClient(reader, writer, metrics)
@@ -0,0 +1,26 @@
+from collections import deque
+
+import numpy as np
+
+
+class SampleClock:
+    def __init__(self, sample_rate=128, window=512, min_points=16):
+        self.sample_rate = sample_rate
+        self.min_points = min_points
+        self._points = deque(maxlen=window)
+
+    def add(self, sample_index, timestamp):
+        self._points.append((sample_index, timestamp))
+
+    def sample_at(self, timestamp):
+        if len(self._points) < self.min_points:
+            return None
+
+        idx, times = np.array(self._points).T
+        if idx[-1] == idx[0]:
+            return None
+        period = np.polyfit(idx, times, 1)[0]
+        # Arrival times only ever lag behind the moment a sample was taken, so the line
+        # is shifted down to the least delayed arrival instead of going through the mean
+        offset = (times - period * idx).min()
+        return (timestamp - offset) / period
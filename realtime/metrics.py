@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from protocol.timing import now
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    def __init__(self, size=2048):
+        self.count = 0
+        self.sum = 0.0
+        self._values = deque(maxlen=size)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self._values.append(value)
+
+    def percentiles(self, qs=PERCENTILES):
+        if not self._values:
+            return [float('nan')] * len(qs)
+        return np.percentile(np.fromiter(self._values, dtype=np.float64), qs).tolist()
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        self.gauges = {}
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def increment(self, name, value=1):
+        self.counters[name] += value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    @contextmanager
+    def time(self, name):
+        start = now()
+        try:
+            yield
+        finally:
+            self.observe(name, now() - start)
+
+    def summary(self):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            p50, p95, p99 = (x * 1000.0 for x in histogram.percentiles())
+            lines.append("{}: n={} p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms".format(
+                name, histogram.count, p50, p95, p99))
+        for name, value in sorted(self.counters.items()):
+            lines.append("{}: {}".format(name, value))
+        for name, value in sorted(self.gauges.items()):
+            lines.append("{}: {:g}".format(name, value))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, prefix='bci_'):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            metric = prefix + name + '_seconds'
+            lines.append("# TYPE {} summary".format(metric))
+            for q, value in zip(PERCENTILES, histogram.percentiles()):
+                lines.append('{}{{quantile="{}"}} {}'.format(metric, q / 100.0, value))
+            lines.append("{}_sum {}".format(metric, histogram.sum))
+            lines.append("{}_count {}".format(metric, histogram.count))
+        for name, value in sorted(self.counters.items()):
+            lines.append("# TYPE {}{}_total counter".format(prefix, name))
+            lines.append("{}{}_total {}".format(prefix, name, value))
+        for name, value in sorted(self.gauges.items()):
+            lines.append("# TYPE {}{} gauge".format(prefix, name))
+            lines.append("{}{} {}".format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    def __init__(self, metrics, interval=10.0, path=None, port=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = path
+        self.port = port
+        self._server = None
+
+    async def run(self):
+        if self.port is not None:
+            self._server = await asyncio.start_server(self._handle_request, 'localhost', self.port)
+
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.export()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def export(self):
+        if self.path is not None:
+            tmp_path = str(self.path) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.metrics.to_prometheus())
+            os.replace(tmp_path, str(self.path))
+
+        # The app shows the session's output in its log window
+        logger.info("Session metrics:\n%s", self.metrics.summary())
+
+    async def _handle_request(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.metrics.to_prometheus().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class LoopMonitor:
+    def __init__(self, metrics, interval=0.05, stall_threshold=0.05):
+        self.metrics = metrics
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+
+    async def run(self):
+        while True:
+            start = now()
+            await asyncio.sleep(self.interval)
+            # Anything beyond the requested sleep is time the loop spent on something else
+            stall = now() - start - self.interval
+            self.metrics.observe('loop_stall', max(stall, 0.0))
+            if stall > self.stall_threshold:
+                self.metrics.increment('loop_stalls')
@@ -1,65 +1,168 @@
 import asyncio
-from concurrent.futures.thread import ThreadPoolExecutor
+import heapq
+
+import numpy as np
 
 from model import PreprocessingStrategy
+from protocol.timing import now
+from realtime.clock import SampleClock
+from realtime.metrics import Metrics
+from realtime.quality import QualityMonitor
 
 
 class Preproc:
-    def __init__(self, preprocessing_strategy: PreprocessingStrategy):
+    def __init__(self, preprocessing_strategy: PreprocessingStrategy, capacity=16384, on_batch=None,
+                 metrics=None, quality: QualityMonitor = None):
         self.preprocessing_strategy = preprocessing_strategy
-        self._segments = set()
+        self.capacity = capacity
+        self.on_batch = on_batch
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.quality = quality
+        self.clock = SampleClock(preprocessing_strategy.sample_rate)
+
+        # Every sample is stored twice, at i and i + capacity, so that any window
+        # of up to capacity samples is a contiguous slice of the buffer
+        self._buffer = None
+        self._waiting = []
+        self._processed = 0
         self._counter = 0
 
+        self._arrivals = np.zeros(capacity)
+        self._first_arrival = None
+        self._last_arrival = None
+
     async def run(self, cykit_client, executor=None):
-        batch = []
+        batch_size = self.preprocessing_strategy.batch_size
+        chunks, num_pending = [], 0
         batch_start = self._counter
 
-        async for sample in cykit_client:
-            batch.append(sample)
-            self._counter += 1
-            if len(batch) < self.preprocessing_strategy.batch_size:
-                continue
-
-            with ThreadPoolExecutor() as executor:
-                loop = asyncio.get_event_loop()
-                preprocessed_batch = await loop.run_in_executor(
-                    executor, self.preprocessing_strategy.preprocess_batch, batch)
-            for segment in self._segments:
-                segment.append_batch(preprocessed_batch, batch_start)
-
-            batch = []
-            batch_start = self._counter
+        async for timestamp, chunk in cykit_client.chunks():
+            self._register_arrival(timestamp, len(chunk))
+            self.clock.add(self._counter + len(chunk) - 1, timestamp)
+            # Raw samples are checked as they arrive, so the flags are ready before their segments complete
+            if self.quality is not None:
+                self.quality.update(self._counter, chunk)
+            chunks.append(chunk)
+            num_pending += len(chunk)
+            self._counter += len(chunk)
+
+            while num_pending >= batch_size:
+                pending = np.concatenate(chunks)
+                batch, rest = pending[:batch_size], pending[batch_size:]
+                chunks, num_pending = [rest], len(rest)
+
+                # Batches must go through a single-threaded executor, as strategies may carry state between them
+                with self.metrics.time('preprocessing'):
+                    preprocessed_batch = await asyncio.get_event_loop().run_in_executor(
+                        executor, self.preprocessing_strategy.preprocess_batch, batch)
+                self.metrics.observe('batch_latency', now() - self._last_arrival)
+                self._write(preprocessed_batch, batch_start)
+                self._resolve_segments()
+                if self.on_batch is not None:
+                    self.on_batch(batch_start, batch, preprocessed_batch)
+
+                batch_start += batch_size
 
     async def get_segment(self, duration=128):
-        segment = PartialSegment(duration, self._counter)
-
-        self._segments.add(segment)
+        segment = self.open_segment(duration)
         data = await segment.get_complete_data()
-        self._segments.discard(segment)
-
         return segment.start, data
 
+    def open_segment(self, duration=128, start=None):
+        if duration > self.capacity:
+            raise ValueError("Segment duration exceeds preprocessing buffer capacity")
+
+        segment = PartialSegment(duration, self._counter if start is None else start)
+        heapq.heappush(self._waiting, segment)
+        return segment
+
+    def sample_at(self, timestamp):
+        sample = self.clock.sample_at(timestamp)
+        if sample is None:
+            # Until the clock has enough points, samples are assumed to arrive right as they are taken
+            sample = self._counter + (timestamp - now()) * self.preprocessing_strategy.sample_rate
+        return round(sample)
+
+    def reanchor(self, segment, start):
+        # Segments can only be moved as far back as the buffer reaches
+        if start < max(0, self._processed - self.capacity):
+            return False
+
+        if segment.done():
+            # Whoever awaits the segment from now on gets the data at its new position
+            self.metrics.increment('late_reanchors')
+            segment.reset()
+        else:
+            self._waiting.remove(segment)
+        segment.start, segment.end = start, start + segment.duration
+        self._waiting.append(segment)
+        heapq.heapify(self._waiting)
+        if self._buffer is not None:
+            self._resolve_segments()
+        return True
+
+    def _register_arrival(self, timestamp, num_samples):
+        sample_period = 1.0 / self.preprocessing_strategy.sample_rate
+
+        # A chunk holds every sample received since the previous read, so its samples
+        # are assumed to have been produced at the nominal rate up to the arrival time
+        times = timestamp - sample_period * np.arange(num_samples - 1, -1, -1)
+        if self._first_arrival is None:
+            self._first_arrival = times[0]
+        elif times[0] - self._last_arrival > 2 * sample_period:
+            self.metrics.increment('late_samples')
+        self._last_arrival = timestamp
+        self._arrivals[(self._counter + np.arange(num_samples)) % self.capacity] = times
+
+        # Samples that should have arrived by now according to the nominal sample rate but have not
+        received = self._counter + num_samples
+        self.metrics.set('sample_backlog', (timestamp - self._first_arrival) / sample_period + 1 - received)
+
+    def _write(self, batch, start):
+        batch = np.asarray(batch, dtype=np.float32)
+        if self._buffer is None:
+            self._buffer = np.zeros((2 * self.capacity, batch.shape[1]), dtype=np.float32)
+
+        idx = (start + np.arange(len(batch))) % self.capacity
+        self._buffer[idx] = batch
+        self._buffer[idx + self.capacity] = batch
+        self._processed = start + len(batch)
+
+    def _resolve_segments(self):
+        completed = now()
+        while self._waiting and self._waiting[0].end <= self._processed:
+            segment = heapq.heappop(self._waiting)
+            self.metrics.observe('segment_delay', completed - self._arrivals[(segment.end - 1) % self.capacity])
+            offset = segment.start % self.capacity
+            clean = self.quality is None or self.quality.is_clean(segment.start, segment.end)
+            # The view stays valid until another capacity samples have been written
+            segment.complete(self._buffer[offset:(offset + segment.duration)], clean)
+
 
 class PartialSegment:
     def __init__(self, duration, start):
         self.duration = duration
         self.start = start
+        self.end = start + duration
+        # Cleared when the raw signal under the segment had an artifact
+        self.clean = True
 
-        self._first_batch_start = None
-        self._samples = []
-        self._queue = asyncio.Queue()
+        self._future = asyncio.get_event_loop().create_future()
 
-    async def get_complete_data(self):
-        return await self._queue.get()
+    def __lt__(self, other):
+        return self.end < other.end
 
-    def append_batch(self, batch, batch_start):
-        self._samples += batch
+    def done(self):
+        return self._future.done()
+
+    async def get_complete_data(self):
+        return await self._future
 
-        if self._first_batch_start is None:
-            self._first_batch_start = batch_start
-        offset = self.start - self._first_batch_start
-        if len(self._samples) - offset < self.duration:
-            return
+    def reset(self):
+        self.clean = True
+        self._future = asyncio.get_event_loop().create_future()
 
-        self._samples = self._samples[offset:(offset + self.duration)]
-        self._queue.put_nowait(self._samples)
+    def complete(self, data, clean=True):
+        if not self._future.done():
+            self.clean = clean
+            self._future.set_result(data)
@@ -0,0 +1,86 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+GOOD, FLAT, NOISY, ARTIFACT = range(4)
+
+
+class QualityMonitor:
+    def __init__(self, sample_rate=128, window=256, artifact_window=32, update_interval=32, capacity=16384,
+                 line_frequency=50.0, min_noise=0.5, max_noise=50.0, max_line_noise=10.0, max_peak_to_peak=150.0):
+        self.sample_rate = sample_rate
+        self.window = window
+        self.artifact_window = artifact_window
+        self.update_interval = update_interval
+        self.capacity = capacity
+        self.line_frequency = line_frequency
+        self.min_noise = min_noise
+        self.max_noise = max_noise
+        self.max_line_noise = max_line_noise
+        self.max_peak_to_peak = max_peak_to_peak
+
+        self.noise = None
+        self.line_noise = None
+        self.peak_to_peak = None
+        self.status = None
+
+        self._recent = None
+        self._artifacts = np.zeros(capacity, dtype=bool)
+        self._processed = 0
+        self._channels_updated = None
+
+        # Hann-windowed projection on the mains frequency, so that drift doesn't leak into it
+        t = np.arange(window) / sample_rate
+        taper = np.hanning(window)
+        self._line_kernel = taper * np.exp(-2j * np.pi * line_frequency * t) * 2.0 / taper.sum()
+
+    def update(self, start, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self._recent is None:
+            self._recent = chunk[:0]
+        history = np.concatenate([self._recent, chunk])
+        self._recent = history[-self.window:]
+        # Channel statistics change slowly and are only recomputed every update_interval samples
+        if self._channels_updated is None or start + len(chunk) - self._channels_updated >= self.update_interval:
+            self._update_channels()
+            self._channels_updated = start + len(chunk)
+
+        # Peak-to-peak amplitude of the short window ending at every new sample, on all usable channels.
+        # The start of the stream is padded with its first sample, which adds nothing to the range
+        n, w = len(chunk), self.artifact_window
+        tail = history[-(n + w - 1):]
+        if len(tail) < n + w - 1:
+            tail = np.concatenate([np.repeat(tail[:1], n + w - 1 - len(tail), axis=0), tail])
+        windows = as_strided(tail, shape=(n, w, tail.shape[1]),
+                             strides=(tail.strides[0], tail.strides[0], tail.strides[1]))
+        usable = (self.status != FLAT) & (self.status != NOISY)
+        ranges = windows[:, :, usable].max(axis=1) - windows[:, :, usable].min(axis=1)
+        self._artifacts[(start + np.arange(n)) % self.capacity] = (ranges > self.max_peak_to_peak).any(axis=1)
+        self._processed = start + n
+
+    def is_clean(self, start, end):
+        # Samples that have fallen out of the buffer (or not arrived yet) can't be checked and count as clean
+        start = max(start, self._processed - self.capacity)
+        end = min(end, self._processed)
+        if start >= end:
+            return True
+        return not self._artifacts[np.arange(start, end) % self.capacity].any()
+
+    def channel_quality(self):
+        if self.status is None:
+            return []
+        return list(zip(self.status.tolist(), self.noise.tolist(), self.line_noise.tolist(),
+                        self.peak_to_peak.tolist()))
+
+    def _update_channels(self):
+        recent = self._recent
+        # Median absolute deviation, so that a blink doesn't make the whole channel look noisy
+        self.noise = 1.4826 * np.median(np.abs(recent - np.median(recent, axis=0)), axis=0)
+        self.peak_to_peak = recent.max(axis=0) - recent.min(axis=0)
+        centered = recent - recent.mean(axis=0)
+        self.line_noise = np.abs(self._line_kernel[len(self._line_kernel) - len(recent):] @ centered)
+
+        status = np.full(recent.shape[1], GOOD)
+        status[self.peak_to_peak > self.max_peak_to_peak] = ARTIFACT
+        status[(self.noise > self.max_noise) | (self.line_noise > self.max_line_noise)] = NOISY
+        status[self.noise < self.min_noise] = FLAT
+        self.status = status
@@ -0,0 +1,45 @@
+import random
+
+
+class StimulusScheduler:
+    def __init__(self, stimuli, group=None, min_distance=2, threshold=None, min_candidates=2):
+        self.stimuli = list(stimuli)
+        self.group = group if group is not None else (lambda stimulus: None)
+        self.min_distance = min_distance
+        self.threshold = threshold
+        self.min_candidates = min_candidates
+        self.candidates = list(self.stimuli)
+
+        self._position = 0
+        self._last_flash = {}
+
+    def update(self, marginals):
+        # Stimuli whose posterior fell below the threshold are left out of the following rounds,
+        # but every group (e.g. rows and columns) keeps its most likely stimuli to compare
+        if self.threshold is None:
+            return
+        candidates = []
+        for group in dict.fromkeys(map(self.group, self.stimuli)):
+            ranked = sorted((s for s in self.stimuli if self.group(s) == group),
+                            key=lambda s: marginals.get(s, 1.0), reverse=True)
+            candidates += [s for i, s in enumerate(ranked)
+                           if i < self.min_candidates or marginals.get(s, 1.0) >= self.threshold]
+        self.candidates = candidates
+
+    def next_round(self):
+        # Every candidate is flashed once in random order, and no stimulus comes back sooner than
+        # min_distance flashes after its previous flash. Where no candidate can go, the slot is left empty (None)
+        remaining = random.sample(self.candidates, len(self.candidates))
+        slots = []
+        while remaining:
+            allowed = [s for s in remaining
+                       if self._position - self._last_flash.get(s, -self.min_distance) >= self.min_distance]
+            if allowed:
+                stimulus = allowed[0]
+                remaining.remove(stimulus)
+                self._last_flash[stimulus] = self._position
+            else:
+                stimulus = None
+            slots.append(stimulus)
+            self._position += 1
+        return slots
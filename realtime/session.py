@@ -1,56 +1,148 @@
 import asyncio
+import itertools
+import logging
+import math
 import random
 from argparse import Namespace
-from concurrent.futures import ThreadPoolExecutor
 
-from model import PreprocessingStrategy, Model
+import numpy as np
+
+from model import EpochAccumulator, PreprocessingStrategy, Model, SymbolPrior, UniformPrior
+from protocol.timing import now
 from realtime.acquisition import connect_to_cykit
 from realtime.app_interaction import connect_to_app
+from realtime.metrics import LoopMonitor, Metrics, MetricsExporter
 from realtime.preprocessing import Preproc
+from realtime.quality import GOOD, QualityMonitor
+from realtime.scheduling import StimulusScheduler
+from realtime.workers import Workers
 
 LETTERS = ['ABCDEF', 'GHIJKL', 'MNOPQR', 'STUVWX', 'YZ0123', '456789']
 NUM_MOUSE_CLASSES = 5
+# Flash acknowledgements that move an epoch by more than this are considered bogus
+MAX_ALIGNMENT_CORRECTION = 0.5
+# Scheduled rounds start this long after they are sent, so that the app gets them in time
+SCHEDULE_LEAD = 0.05
+# How long after its planned onset the report of a scheduled flash is waited for before its epoch is taken as is
+ONSET_REPORT_TIMEOUT = 1.0
+# Classifier probabilities are clipped to this distance from 0 and 1 before being turned into evidence
+MIN_PROBABILITY = 1e-6
+# Number of typed letters kept as the language model context
+MAX_CONTEXT = 16
+
+logger = logging.getLogger(__name__)
 
 
 class Session:
-    def __init__(self, args: Namespace, preprocessing_strategy: PreprocessingStrategy, model: Model):
+    def __init__(self, args: Namespace, preprocessing_strategy: PreprocessingStrategy, model: Model,
+                 workers: Workers = None, prior: SymbolPrior = None):
         self.preprocessing_strategy = preprocessing_strategy
         self.model = model
+        self.prior = prior if prior is not None else UniformPrior(''.join(LETTERS))
         self.args = args
+        self._owns_workers = workers is None
+        self.workers = workers if workers is not None else Workers()
         self._cykit_client = None
         self._interaction_client = None
-        self._preproc = Preproc(self.preprocessing_strategy)
-        self._executor = None
-        self._wait_for_executor()
+        self.metrics = Metrics()
+        self._quality = QualityMonitor(sample_rate=preprocessing_strategy.sample_rate,
+                                       line_frequency=args.line_frequency, max_peak_to_peak=args.max_peak_to_peak)
+        self._preproc = Preproc(self.preprocessing_strategy, on_batch=self._record_signal, metrics=self.metrics,
+                                quality=self._quality)
+        self._active = False
+        self._flash_ids = itertools.count()
+        self._unacknowledged_flashes = {}
+        self._typed = ''
 
     async def run(self):
+        tasks = []
         try:
             self._cykit_client = await connect_to_cykit(self.args.cykit_address, self.args.cykit_port)
-            self._interaction_client = await connect_to_app(self.args.interaction_port)
-            await asyncio.gather(
-                self._preproc.run(self._cykit_client, self._executor),
-                self._run_session())
+            self._interaction_client = await connect_to_app(
+                self.args.interaction_port, self.metrics, self.args.interaction_socket)
+            self._interaction_client.on_flash_ack = self._handle_flash_ack
+
+            coros = [
+                self._preproc.run(self._cykit_client, self.workers.preprocessing),
+                self._run_session(),
+                LoopMonitor(self.metrics).run(),
+            ]
+            if self.args.quality_interval > 0:
+                coros.append(self._report_quality())
+            if self.args.metrics_interval > 0:
+                exporter = MetricsExporter(self.metrics, self.args.metrics_interval,
+                                           self.args.metrics_file, self.args.metrics_port)
+                coros.append(exporter.run())
+            tasks = [asyncio.ensure_future(coro) for coro in coros]
+            await asyncio.gather(*tasks)
 
         finally:
             self.stop()
+            # Other sessions may share the loop, so nothing of this one is left running after it ends
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def stop(self):
         if self._cykit_client is not None:
             self._cykit_client.stop()
         if self._interaction_client is not None:
             self._interaction_client.stop()
+        self.model.close()
+        if self._owns_workers:
+            self.workers.shutdown(wait=False)
 
     async def _run_session(self):
         while True:
             meta = await self._interaction_client.request_config()
-            if meta['mode'] == 'keyboard':
-                await self._run_keyboard_iteration(meta['train'])
-            elif meta['mode'] == 'mouse':
-                await self._run_mouse_iteration(meta['train'])
-            else:
-                raise RuntimeError("Invalid mode")
-
-    # TODO: Extract common code from this and _run_single_class_iteration
+            active = meta.get('active', True)
+            if active and not self._active:
+                self.model.start_recording()
+            self._active = active
+            if not self._active:
+                # While the app is switched off, the session stays connected and keeps filtering
+                await self._interaction_client.wait_for_config_push()
+                continue
+            await self._run_iteration(meta)
+
+    async def _run_iteration(self, meta):
+        if meta['mode'] == 'keyboard':
+            iteration = asyncio.ensure_future(self._run_keyboard_iteration(meta['train']))
+        elif meta['mode'] == 'mouse':
+            iteration = asyncio.ensure_future(self._run_mouse_iteration(meta['train']))
+        else:
+            raise RuntimeError("Invalid mode")
+
+        pushed = None
+        try:
+            while not iteration.done():
+                pushed = asyncio.ensure_future(self._interaction_client.wait_for_config_push())
+                await asyncio.wait([iteration, pushed], return_when=asyncio.FIRST_COMPLETED)
+                # Switching modes in the app interrupts the iteration being presented
+                if pushed.done() and pushed.result() != meta:
+                    iteration.cancel()
+                    await asyncio.wait([iteration])
+        finally:
+            iteration.cancel()
+            if pushed is not None:
+                pushed.cancel()
+            await asyncio.gather(iteration, return_exceptions=True)
+        if not iteration.cancelled():
+            iteration.result()
+
+    async def _report_quality(self):
+        # Reported while switched off as well, so that sensors can be fixed before flashing starts
+        while True:
+            await asyncio.sleep(self.args.quality_interval)
+            channels = self._quality.channel_quality()
+            if channels:
+                self.metrics.set('bad_channels', sum(status != GOOD for status, *_ in channels))
+                await self._interaction_client.report_quality(channels)
+
+    def _record_signal(self, start, raw, preprocessed):
+        if self._active:
+            self.model.record_signal(start, raw, preprocessed)
+
     async def _run_keyboard_iteration(self, train=False):
         target_row, target_col = None, None
         if train:
@@ -60,33 +152,25 @@ class Session:
             asyncio.create_task(self._interaction_client.signal('keyboard_highlight_letter', target_letter))
             await asyncio.sleep(self.args.highlight_time)
 
-        stimuli = []
-        for _ in range(self.args.num_repetitions):
-            for i in range(len(LETTERS)):
-                stimuli.append(('row', i))
-            for i in range(len(LETTERS[0])):
-                stimuli.append(('col', i))
-        random.shuffle(stimuli)
-
-        futures = []
-        for stimulus_type, idx in stimuli:
-            if stimulus_type == 'row':
-                asyncio.create_task(self._interaction_client.signal('keyboard_flash_row', idx))
-            elif stimulus_type == 'col':
-                asyncio.create_task(self._interaction_client.signal('keyboard_flash_col', idx))
-            fut = asyncio.create_task(self._preproc.get_segment(duration=self.args.segment_duration))
-            futures.append(fut)
-            await asyncio.sleep(self.args.tti)
+        stimuli = [('row', i) for i in range(len(LETTERS))] + [('col', i) for i in range(len(LETTERS[0]))]
+        scheduler = self._create_scheduler(stimuli, lambda stimulus: stimulus[0], train)
+
+        # The context doesn't change while the letter is being flashed, so its prior is looked up once
+        log_prior = self.prior.log_probabilities(self._typed).reshape(len(LETTERS), len(LETTERS[0]))
+        is_confident = lambda probs: self._letter_posterior(probs, log_prior).max() >= self.args.stopping_threshold
+        marginals = lambda probs: self._letter_marginals(self._letter_posterior(probs, log_prior))
 
-        segments = await asyncio.gather(*futures)
+        epochs = await self._present_stimuli(
+            scheduler, self._keyboard_signal, None if train else is_confident, None if train else marginals)
         if train:
             target = [('row', target_row), ('col', target_col)]
-            asyncio.create_task(self._train_iteration(stimuli, segments, target))
+            asyncio.create_task(self._train_iteration(epochs, target))
         else:
-            probs = await self._get_probabilities(stimuli, segments)
-            relevant_row = max(filter(lambda x: x[0] == 'row', probs), key=probs.get)[1]
-            relevant_col = max(filter(lambda x: x[0] == 'col', probs), key=probs.get)[1]
+            probs = await self._get_probabilities(epochs)
+            posterior = self._letter_posterior(probs, log_prior)
+            relevant_row, relevant_col = np.unravel_index(posterior.argmax(), posterior.shape)
             relevant_letter = LETTERS[relevant_row][relevant_col]
+            self._typed = (self._typed + relevant_letter)[-MAX_CONTEXT:]
             asyncio.create_task(self._interaction_client.signal('keyboard_select_letter', relevant_letter))
 
         # During this time, any extra unprocessed packets will be ignored to avoid latency
@@ -99,37 +183,211 @@ class Session:
             asyncio.create_task(self._interaction_client.signal('mouse_highlight_class', target_class))
             await asyncio.sleep(self.args.highlight_time)
 
-        stimuli = list(range(NUM_MOUSE_CLASSES)) * self.args.num_repetitions
-        random.shuffle(stimuli)
-
-        futures = []
-        for idx in stimuli:
-            asyncio.create_task(self._interaction_client.signal('mouse_flash_class', idx))
-            fut = asyncio.create_task(self._preproc.get_segment(duration=self.args.segment_duration))
-            futures.append(fut)
-            await asyncio.sleep(self.args.tti)
-
-        segments = await asyncio.gather(*futures)
+        scheduler = self._create_scheduler(range(NUM_MOUSE_CLASSES), train=train)
+        epochs = await self._present_stimuli(
+            scheduler, self._mouse_signal, None if train else self._is_mouse_confident,
+            None if train else self._normalize)
         if train:
-            asyncio.create_task(self._train_iteration(stimuli, segments, [target_class]))
+            asyncio.create_task(self._train_iteration(epochs, [target_class]))
         else:
-            probs = await self._get_probabilities(stimuli, segments)
+            probs = await self._get_probabilities(epochs)
             relevant_class = max(probs, key=probs.get)
             asyncio.create_task(self._interaction_client.signal('mouse_select_class', relevant_class))
 
         await asyncio.sleep(self.args.delay_between_iters)
 
-    async def _train_iteration(self, stimuli, segments, target):
-        self._wait_for_executor()
-        return await asyncio.get_event_loop().run_in_executor(
-            self._executor, self.model.train_iteration, stimuli, segments, target)
+    def _create_scheduler(self, stimuli, group=None, train=False):
+        # The same stimulus is never flashed again sooner than the minimum target-to-target interval.
+        # Training flashes every stimulus, so that the classifier sees targets and non-targets alike
+        min_distance = max(2, math.ceil(round(self.args.min_target_interval / self.args.tti, 6)))
+        return StimulusScheduler(stimuli, group, min_distance, None if train else self.args.prune_threshold)
+
+    async def _present_stimuli(self, scheduler, signal_for, is_confident=None, marginals=None):
+        # With a confidence test, the stimuli flashed so far are scored after every round,
+        # and flashing stops as soon as one of these intermediate scores is confident enough.
+        # The latest of these scores also lets the scheduler leave out stimuli that are no longer plausible
+        if self.args.stopping_threshold is None:
+            is_confident = None
+        if scheduler.threshold is None:
+            marginals = None
+
+        # Epochs are summed per stimulus as they complete, so the averages are ready with the last one
+        epochs = EpochAccumulator(keep_segments=self.model.needs_segments)
+        futures, evaluations = [], []
+        should_stop = lambda: is_confident is not None and self._any_confident(evaluations, is_confident)
+        present_round = self._schedule_round if self.args.schedule else self._flash_round
+        try:
+            num_rounds = self.args.num_repetitions
+            for round_idx in range(num_rounds):
+                latest = self._latest_score(evaluations)
+                if marginals is not None and latest is not None:
+                    scheduler.update(marginals(latest))
+                if await present_round(scheduler.next_round(), signal_for, epochs, futures, should_stop):
+                    break
+                if (is_confident is not None or marginals is not None) and \
+                        self.args.min_repetitions <= round_idx + 1 < num_rounds:
+                    evaluations.append(asyncio.create_task(self._score(epochs, list(futures))))
+
+            await asyncio.gather(*futures)
+        finally:
+            for task in futures + evaluations:
+                task.cancel()
+            await asyncio.gather(*futures, *evaluations, return_exceptions=True)
+            self._unacknowledged_flashes.clear()
+        return epochs
+
+    async def _flash_round(self, round_stimuli, signal_for, epochs, futures, should_stop):
+        for stimulus in round_stimuli:
+            if should_stop():
+                return True
+            if stimulus is None:
+                await asyncio.sleep(self.args.tti)
+                continue
+
+            flash_id = next(self._flash_ids)
+            segment = self._preproc.open_segment(duration=self.args.segment_duration)
+            self._unacknowledged_flashes[flash_id] = (segment, now(), None)
+            asyncio.create_task(self._interaction_client.signal(*signal_for(stimulus), ack=flash_id))
+            futures.append(asyncio.create_task(self._collect_epoch(epochs, stimulus, segment)))
+            await asyncio.sleep(self.args.tti)
+        return False
+
+    async def _schedule_round(self, round_stimuli, signal_for, epochs, futures, should_stop):
+        # The whole round is sent at once and flashed by the app's own timer. Epochs start
+        # where the clock places the planned onsets and are moved once the app reports them
+        if should_stop():
+            return True
+
+        start = now() + SCHEDULE_LEAD
+        entries = []
+        for i, stimulus in enumerate(round_stimuli):
+            if stimulus is None:
+                continue
+            onset = start + i * self.args.tti
+            flash_id = next(self._flash_ids)
+            segment = self._preproc.open_segment(self.args.segment_duration, self._preproc.sample_at(onset))
+            reported = asyncio.get_event_loop().create_future()
+            self._unacknowledged_flashes[flash_id] = (segment, onset, reported)
+            entries.append((flash_id, *signal_for(stimulus), onset))
+            futures.append(asyncio.create_task(self._collect_epoch(epochs, stimulus, segment, reported, onset)))
+
+        await self._interaction_client.schedule(entries)
+        await asyncio.sleep(start + len(round_stimuli) * self.args.tti - now())
+        return False
+
+    async def _collect_epoch(self, epochs, stimulus, segment, reported=None, onset=None):
+        start, data = await self._wait_for_segment(segment, reported, onset)
+        if reported is not None and not reported.done():
+            self.metrics.increment('missed_onset_reports')
+        # Epochs with artifacts are only averaged for stimuli that have no clean repetition
+        if not segment.clean:
+            self.metrics.increment('artifact_epochs')
+        epochs.add(stimulus, start, data, segment.clean or not self.args.reject_artifacts)
+
+    @staticmethod
+    async def _wait_for_segment(segment, reported=None, onset=None):
+        # Epoch tasks of a whole round are created up front, so the timeout runs from the flash's own onset
+        if reported is not None:
+            await asyncio.wait([reported], timeout=max(0.0, onset + ONSET_REPORT_TIMEOUT - now()))
+        data = await segment.get_complete_data()
+        return segment.start, data
+
+    def _handle_flash_ack(self, flash_id, timestamp):
+        # The epoch is re-anchored at the sample that was taken when the flash actually appeared
+        if flash_id not in self._unacknowledged_flashes:
+            return
+        segment, expected, reported = self._unacknowledged_flashes.pop(flash_id)
+        if reported is None:
+            self.metrics.observe('flash_ack', timestamp - expected)
+        else:
+            reported.set_result(None)
+            self.metrics.observe('onset_error', abs(timestamp - expected))
+
+        sample = self._preproc.clock.sample_at(timestamp)
+        if sample is None:
+            return
+        correction = (round(sample) - segment.start) / self.preprocessing_strategy.sample_rate
+        if abs(correction) > MAX_ALIGNMENT_CORRECTION:
+            logger.warning("Ignoring flash acknowledgement off by %.3f s", correction)
+            self.metrics.increment('rejected_flash_acks')
+        elif self._preproc.reanchor(segment, round(sample)):
+            self.metrics.observe('alignment_correction', abs(correction))
+
+    @staticmethod
+    def _keyboard_signal(stimulus):
+        stimulus_type, idx = stimulus
+        return 'keyboard_flash_' + stimulus_type, idx
+
+    @staticmethod
+    def _mouse_signal(idx):
+        return 'mouse_flash_class', idx
+
+    @staticmethod
+    def _letter_posterior(probs, log_prior):
+        # A letter is the target if both its row and its column are, so their log odds add up
+        # to the letter's evidence, which is then weighed by the prior
+        rows, cols = log_prior.shape
+        row_odds = Session._log_odds([probs.get(('row', i), 0.5) for i in range(rows)])
+        col_odds = Session._log_odds([probs.get(('col', i), 0.5) for i in range(cols)])
+        log_posterior = log_prior + row_odds[:, None] + col_odds[None, :]
+        posterior = np.exp(log_posterior - log_posterior.max())
+        return posterior / posterior.sum()
+
+    @staticmethod
+    def _letter_marginals(posterior):
+        marginals = {('row', i): p for i, p in enumerate(posterior.sum(axis=1))}
+        marginals.update({('col', i): p for i, p in enumerate(posterior.sum(axis=0))})
+        return marginals
+
+    @staticmethod
+    def _log_odds(p):
+        p = np.clip(p, MIN_PROBABILITY, 1.0 - MIN_PROBABILITY)
+        return np.log(p) - np.log1p(-p)
+
+    def _is_mouse_confident(self, probs):
+        return self._max_posterior(probs) >= self.args.stopping_threshold
+
+    @staticmethod
+    def _max_posterior(probs):
+        total = sum(probs.values())
+        if total <= 0:
+            return 0.0
+        return max(probs.values()) / total
+
+    @staticmethod
+    def _normalize(probs):
+        total = sum(probs.values())
+        if total <= 0:
+            return {}
+        return {k: v / total for k, v in probs.items()}
+
+    @staticmethod
+    def _latest_score(evaluations):
+        for e in reversed(evaluations):
+            if e.done() and not e.cancelled() and e.exception() is None:
+                return e.result()
+        return None
+
+    @staticmethod
+    def _any_confident(evaluations, is_confident):
+        return any(e.done() and not e.cancelled() and e.exception() is None and is_confident(e.result())
+                   for e in evaluations)
+
+    async def _score(self, epochs, futures):
+        await asyncio.gather(*futures)
+        # Later epochs keep being added while the model thread scores this snapshot
+        with self.metrics.time('model_scoring'):
+            return await self._run_model(self.model.score, epochs.copy())
+
+    async def _train_iteration(self, epochs, target):
+        with self.metrics.time('model_training'):
+            return await self._run_model(self.model.train_iteration, epochs, target)
 
-    async def _get_probabilities(self, stimuli, segments):
-        self._wait_for_executor()
-        return await asyncio.get_event_loop().run_in_executor(
-            self._executor, self.model.get_probabilities, stimuli, segments)
+    async def _get_probabilities(self, epochs):
+        with self.metrics.time('model_scoring'):
+            return await self._run_model(self.model.get_probabilities, epochs)
 
-    def _wait_for_executor(self):
-        if self._executor is not None:
-            self._executor.shutdown(wait=True)
-        self._executor = ThreadPoolExecutor()
+    def _run_model(self, fn, *args):
+        # The model queue is single-threaded, so a training iteration always
+        # finishes before any scoring that was requested after it
+        return asyncio.get_event_loop().run_in_executor(self.workers.model, fn, *args)
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import random
+from struct import Struct
+
+import numpy as np
+
+from protocol import CONFIG, FLAG_PUSH, QUALITY, REQUEST_CONFIG, SCHEDULE, decode_quality, decode_schedule, \
+    decode_signal, encode_batch, encode_flash_ack, encode_json, read_frames
+from protocol.timing import now
+from realtime.session import LETTERS, NUM_MOUSE_CLASSES
+
+logger = logging.getLogger(__name__)
+
+# Emotiv EPOC+ channel order: AF3 F7 F3 FC5 T7 P7 O1 O2 P8 T8 FC6 F4 F8 AF4
+P300_WEIGHTS = np.array([0.2, 0.2, 0.4, 0.5, 0.5, 1.0, 0.8, 0.8, 1.0, 0.5, 0.5, 0.4, 0.2, 0.2])
+# Blinks show up mostly on the frontal channels
+BLINK_WEIGHTS = np.array([1.0, 0.6, 0.5, 0.2, 0.05, 0.0, 0.0, 0.0, 0.0, 0.05, 0.2, 0.5, 0.6, 1.0])
+
+
+class CyKitSimulator:
+    def __init__(self, channels=14, sample_rate=128, noise=10.0, offset=4200.0,
+                 p300_amplitude=5.0, p300_latency=0.3, p300_width=0.05, blink_rate=0.0, blink_amplitude=300.0,
+                 source=None):
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.noise = noise
+        self.offset = offset
+        self.source = source
+        self.port = None
+
+        t = np.arange(int(2 * p300_latency * sample_rate)) / sample_rate
+        bump = p300_amplitude * np.exp(-0.5 * ((t - p300_latency) / p300_width) ** 2)
+        self._p300 = np.outer(bump, P300_WEIGHTS[:channels])
+
+        # Blinks happen at random, blink_rate times per second on average
+        self.blink_rate = blink_rate
+        t = np.arange(int(0.4 * sample_rate)) / sample_rate
+        self._blink = np.outer(blink_amplitude * np.exp(-0.5 * ((t - 0.2) / 0.06) ** 2), BLINK_WEIGHTS[:channels])
+
+        self._struct = Struct('>' + 'f' * channels)
+        self._pending = np.zeros((0, channels))
+        self._counter = 0
+        self._server = None
+
+    async def start(self, host='localhost', port=0):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+
+    def inject_p300(self):
+        self._inject(self._p300)
+
+    def inject_blink(self):
+        self._inject(self._blink)
+
+    def _inject(self, response):
+        # The response is added to the samples that have not been streamed yet, time-locked to this call
+        n = max(len(self._pending), len(response))
+        pending = np.zeros((n, self.channels))
+        pending[:len(self._pending)] += self._pending
+        pending[:len(response)] += response
+        self._pending = pending
+
+    def _next_sample(self):
+        if self.source is not None:
+            sample = np.asarray(self.source[self._counter % len(self.source)], dtype=np.float64)
+        else:
+            sample = self.offset + self.noise * np.random.randn(self.channels)
+        if self.blink_rate > 0 and np.random.rand() < self.blink_rate / self.sample_rate:
+            self.inject_blink()
+
+        if len(self._pending):
+            sample = sample + self._pending[0]
+            self._pending = self._pending[1:]
+
+        self._counter += 1
+        return sample
+
+    async def _handle_connection(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        start_time = loop.time()
+        sent = 0
+
+        try:
+            while True:
+                due = int((loop.time() - start_time) * self.sample_rate) + 1
+                while sent < due:
+                    writer.write(self._struct.pack(*self._next_sample()))
+                    sent += 1
+                await writer.drain()
+                await asyncio.sleep(start_time + sent / self.sample_rate - loop.time())
+        except ConnectionError:
+            logger.debug("CyKit client disconnected")
+        finally:
+            writer.close()
+
+
+class FakeInteractionApp:
+    def __init__(self, simulator, num_train=0, num_work=1, mode='keyboard', active=True, text=None):
+        self.simulator = simulator
+        self.num_train = num_train
+        self.num_work = num_work
+        self.mode = mode
+        self.active = active
+        self.port = None
+        # Letters the simulated user types in working mode, one per iteration (random letters by default)
+        self.text = [c for c in text.upper() if c in ''.join(LETTERS)] if text is not None else None
+
+        self.iterations = 0
+        self.flash_times = []
+        self.config_times = []
+        self.selections = []
+        self.channel_quality = None
+        self.finished = asyncio.Event()
+
+        self._target = None
+        self._iteration_start = None
+        self._server = None
+        self._writers = set()
+
+    @property
+    def train(self):
+        return self.iterations <= self.num_train
+
+    async def start(self, host='localhost', port=0, path=None):
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+
+    def set_active(self, active):
+        self.active = active
+        for writer in self._writers:
+            writer.write(encode_json(CONFIG, self._config(), FLAG_PUSH))
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                responses = [self._handle_frame(writer, *frame) for frame in await read_frames(reader)]
+                responses = [r for r in responses if r is not None]
+                if responses:
+                    writer.write(responses[0] if len(responses) == 1 else encode_batch(responses))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.debug("Session disconnected")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _handle_frame(self, writer, opcode, flags, payload):
+        if opcode == REQUEST_CONFIG:
+            self.config_times.append(asyncio.get_event_loop().time())
+            return encode_json(CONFIG, self._next_iteration())
+        if opcode == SCHEDULE:
+            asyncio.ensure_future(self._run_schedule(writer, decode_schedule(payload)))
+            return None
+        if opcode == QUALITY:
+            self.channel_quality = decode_quality(payload)
+            return None
+
+        name, args, ack = decode_signal(opcode, flags, payload)
+        getattr(self, '_' + name)(*args)
+        if ack is not None:
+            return encode_flash_ack(ack, now())
+
+    async def _run_schedule(self, writer, entries):
+        for flash_id, name, idx, onset in entries:
+            await asyncio.sleep(onset - now())
+            getattr(self, '_' + name)(idx)
+            # Every onset is reported right away, while its epoch is still being recorded
+            if not writer.is_closing():
+                writer.write(encode_flash_ack(flash_id, now()))
+
+    def _config(self):
+        return {'mode': self.mode, 'train': self.train, 'active': self.active}
+
+    def _next_iteration(self):
+        if not self.active:
+            return self._config()
+        if self.iterations >= self.num_train + self.num_work:
+            self.finished.set()
+        self.iterations += 1
+        self._iteration_start = asyncio.get_event_loop().time()
+
+        # In working mode the simulated user picks a target by themselves
+        if self.mode == 'keyboard' and self.text:
+            self._target = self.text[(self.iterations - self.num_train - 1) % len(self.text)]
+        elif self.mode == 'keyboard':
+            self._target = random.choice(''.join(LETTERS))
+        else:
+            self._target = random.randrange(NUM_MOUSE_CLASSES)
+        return self._config()
+
+    def _flash(self, relevant):
+        self.flash_times.append(asyncio.get_event_loop().time())
+        if relevant:
+            self.simulator.inject_p300()
+
+    def _keyboard_highlight_letter(self, letter):
+        self._target = letter
+
+    def _keyboard_flash_row(self, idx):
+        self._flash(self._target in LETTERS[idx])
+
+    def _keyboard_flash_col(self, idx):
+        self._flash(self._target in [row[idx] for row in LETTERS])
+
+    def _keyboard_select_letter(self, letter):
+        self._select(letter)
+
+    def _mouse_highlight_class(self, idx):
+        self._target = idx
+
+    def _mouse_flash_class(self, idx):
+        self._flash(idx == self._target)
+
+    def _mouse_select_class(self, idx):
+        self._select(idx)
+
+    def _select(self, selected):
+        duration = asyncio.get_event_loop().time() - self._iteration_start
+        self.selections.append((selected == self._target, duration))
+        logger.info("Selected %s (target %s) in %.2f s", selected, self._target, duration)
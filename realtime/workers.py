@@ -0,0 +1,20 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class Workers:
+    def __init__(self, processes=0, cpu=None):
+        # A single thread per queue runs its jobs strictly in submission order
+        self.preprocessing = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preprocessing')
+        self.model = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model')
+        # CPU-heavy fitting (ICA, LDA) can run in separate processes to stay clear of the GIL.
+        # Several sessions in one process may share a single pool
+        self._owns_cpu = cpu is None
+        if cpu is None and processes > 0:
+            cpu = ProcessPoolExecutor(max_workers=processes)
+        self.cpu = cpu
+
+    def shutdown(self, wait=True):
+        self.preprocessing.shutdown(wait=wait)
+        self.model.shutdown(wait=wait)
+        if self.cpu is not None and self._owns_cpu:
+            self.cpu.shutdown(wait=wait)
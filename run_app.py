@@ -2,7 +2,7 @@ import sys
 
 from PySide2.QtCore import QCoreApplication
 
-from app import App
+from app.core import App
 
 
 def main():
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import signal
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import run_session
+from realtime import Workers
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    sessions_args = [run_session.parse_args(argv) for argv in parse_args()]
+    if sessions_args[0].metrics_interval > 0:
+        logging.getLogger('realtime.metrics').setLevel(logging.INFO)
+
+    # Sessions share one process pool for model and ICA fitting, but keep their own ordered queues
+    processes = sessions_args[0].processes
+    cpu = ProcessPoolExecutor(max_workers=processes) if processes > 0 else None
+    sessions = [run_session.create_session(args, Workers(cpu=cpu)) for args in sessions_args]
+
+    loop = asyncio.get_event_loop()
+
+    def stop():
+        for session in sessions:
+            session.stop()
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop)
+        loop.add_signal_handler(signal.SIGTERM, stop)
+    except NotImplementedError:
+        pass
+
+    try:
+        loop.run_until_complete(run(sessions, sessions_args))
+    except KeyboardInterrupt:
+        stop()
+    finally:
+        loop.close()
+        if cpu is not None:
+            cpu.shutdown()
+
+
+async def run(sessions, sessions_args):
+    # A failing headset only ends its own session
+    results = await asyncio.gather(*(session.run() for session in sessions), return_exceptions=True)
+    for args, result in zip(sessions_args, results):
+        if isinstance(result, Exception):
+            logger.error("Session for %s:%d failed: %r", args.cykit_address, args.cykit_port, result)
+
+
+def parse_session(value):
+    parts = value.split(':')
+    if len(parts) not in (3, 4):
+        raise ValueError(value)
+    return parts
+
+
+def parse_args():
+    parser = ArgumentParser(description='Run several sessions, one per headset, in a single process. '
+                                        'Other arguments are passed to every session (see run_session.py)')
+    parser.add_argument('--session', help='CyKit address, CyKit port, interaction port and optionally the '
+                        'profile of a session, separated by colons (the profile defaults to ADDRESS-PORT)',
+                        dest='sessions', metavar='SESSION', type=parse_session, action='append', required=True)
+    args, session_argv = parser.parse_known_args()
+
+    # Sessions without a profile of their own are named after their headset, as sessions
+    # sharing a profile would overwrite each other's recordings and model
+    profiles = [parts[3] if len(parts) == 4 else '{}-{}'.format(*parts[:2]) for parts in args.sessions]
+    duplicates = sorted({profile for profile in profiles if profiles.count(profile) > 1})
+    if duplicates:
+        parser.error("every session needs its own profile, shared: {}".format(', '.join(duplicates)))
+
+    # Session positional arguments have to follow the session's own address and ports
+    return [parts[:3] + session_argv + ['--profile', profile] for parts, profile in zip(args.sessions, profiles)]
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,22 @@ import logging
 import signal
 from argparse import ArgumentParser
 
-from model import ConcretePreprocessingStrategy, LDAModel
-from realtime import Session
+import model
+from model import CachedICA, ConcretePreprocessingStrategy, FeatureExtractor, LDAModel, NgramPrior, OnlineLDAModel, \
+    StreamingPreprocessingStrategy
+from realtime import Session, Workers
+from realtime.session import LETTERS
 
 
 def main():
     logging.basicConfig(level=logging.WARNING)
 
     args = parse_args()
-    preproc_strategy = ConcretePreprocessingStrategy()
-    model = LDAModel()
-    session = Session(args, preproc_strategy, model)
+    if args.metrics_interval > 0:
+        logging.getLogger('realtime.metrics').setLevel(logging.INFO)
+
+    workers = Workers(processes=args.processes)
+    session = create_session(args, workers)
 
     loop = asyncio.get_event_loop()
 
@@ -29,9 +34,55 @@ def main():
         session.stop()
     finally:
         loop.close()
+        workers.shutdown()
+
+
+def create_session(args, workers):
+    return Session(args, create_preprocessing_strategy(args, workers), create_model(args, workers), workers,
+                   create_prior(args))
+
+
+def profile_directory(args):
+    # Every profile keeps its own recordings and models, e.g. one per headset user
+    if args.profile is None:
+        return None
+    return model.CONFIG_DIRECTORY / "profiles" / args.profile
+
+
+def create_model(args, workers=None):
+    extractor = FeatureExtractor(window=args.feature_window, decimation=args.decimation,
+                                 channels=args.channels, xdawn_filters=args.xdawn)
+    if args.online_lda:
+        return OnlineLDAModel(shrinkage=args.lda_shrinkage, extractor=extractor, plot=args.plot,
+                              max_pending=args.record_queue_size, block=args.record_backpressure,
+                              directory=profile_directory(args))
+    return LDAModel(extractor=extractor, plot=args.plot, max_pending=args.record_queue_size,
+                    block=args.record_backpressure, fit_executor=workers.cpu if workers is not None else None,
+                    directory=profile_directory(args))
 
 
-def parse_args():
+def create_prior(args):
+    # Without a language model every letter is equally likely
+    if args.language_model is None:
+        return None
+    return NgramPrior.load(''.join(LETTERS), args.language_model)
+
+
+def create_preprocessing_strategy(args, workers=None):
+    cached_ica = None
+    if args.cache_ica:
+        cached_ica = CachedICA(calibration_size=int(args.ica_calibration * 128),
+                               refit_interval=int(args.ica_refit_interval * 128),
+                               drift_threshold=args.ica_drift_threshold,
+                               executor=workers.cpu if workers is not None else None,
+                               directory=profile_directory(args))
+
+    if args.streaming:
+        return StreamingPreprocessingStrategy(chunk_size=args.chunk_size, cached_ica=cached_ica)
+    return ConcretePreprocessingStrategy(cached_ica=cached_ica)
+
+
+def parse_args(argv=None):
     parser = ArgumentParser()
 
     parser.add_argument('cykit_address', help='IP address CyKit is located at')
@@ -49,7 +100,71 @@ def parse_args():
     parser.add_argument('delay_between_iters', help='Delay between iterations',
                         type=float, nargs='?', default=1.0)
 
-    return parser.parse_args()
+    parser.add_argument('--profile', help='Name of the user profile to keep recordings and models in '
+                        '(~/.bci by default)')
+    parser.add_argument('--interaction-socket', help='Unix domain socket the interaction server listens on '
+                        '(used instead of the interaction port)')
+    parser.add_argument('--schedule', help='Send every round of flashes at once and let the app time them',
+                        action='store_true')
+    parser.add_argument('--streaming', help='Filter incoming samples in small chunks, carrying filter state',
+                        action='store_true')
+    parser.add_argument('--chunk-size', help='Chunk size in samples for streaming preprocessing',
+                        type=int, default=16)
+    parser.add_argument('--cache-ica', help='Fit ICA once on a calibration window and reuse the unmixing matrix',
+                        action='store_true')
+    parser.add_argument('--ica-calibration', help='ICA calibration window in seconds',
+                        type=float, default=30.0)
+    parser.add_argument('--ica-refit-interval', help='Interval in seconds between background ICA refits',
+                        type=float, default=120.0)
+    parser.add_argument('--ica-drift-threshold', help='Mean absolute source correlation that triggers an ICA refit',
+                        type=float, default=0.2)
+    parser.add_argument('--stopping-threshold', help='Stop flashing once the posterior of the best letter (or the '
+                        'normalized posterior of the best mouse class) reaches this value (disabled by default)',
+                        type=float, default=None)
+    parser.add_argument('--prune-threshold', help='Stop flashing rows, columns or mouse classes whose posterior '
+                        'falls below this value for the rest of the selection (disabled by default)',
+                        type=float, default=None)
+    parser.add_argument('--min-target-interval', help='Minimum time in seconds between two flashes of the same '
+                        'stimulus (adjacent repeats are never allowed)', type=float, default=0.5)
+    parser.add_argument('--language-model', help='Character n-gram counts (see build_language_model.py) '
+                        'used as the prior of the keyboard letters')
+    parser.add_argument('--min-repetitions', help='Repetitions to flash before stopping early is considered',
+                        type=int, default=2)
+    parser.add_argument('--reject-artifacts', help='Leave epochs with artifacts out of the averages '
+                        '(unless every repetition of a stimulus has one)', action='store_true')
+    parser.add_argument('--max-peak-to-peak', help='Peak-to-peak amplitude of the raw signal within 250 ms '
+                        'that marks an artifact', type=float, default=150.0)
+    parser.add_argument('--line-frequency', help='Mains frequency in Hz, used to measure line noise',
+                        type=float, default=50.0)
+    parser.add_argument('--quality-interval', help='Interval in seconds between channel quality reports to the app '
+                        '(0 disables them)', type=float, default=2.0)
+    parser.add_argument('--feature-window', help='Part of each epoch used as features, in ms after the flash '
+                        '(applies to new models only)', type=float, nargs=2, default=[200.0, 600.0])
+    parser.add_argument('--decimation', help='Number of samples averaged into one feature sample',
+                        type=int, default=4)
+    parser.add_argument('--channels', help='Indices of the channels used as features (all by default)',
+                        type=int, nargs='+', default=None)
+    parser.add_argument('--xdawn', help='Number of xDAWN spatial filters (0 uses the channels as is)',
+                        type=int, default=0)
+    parser.add_argument('--online-lda', help='Update LDA statistics after every training iteration '
+                        'instead of refitting the classifier', action='store_true')
+    parser.add_argument('--lda-shrinkage', help='Covariance shrinkage of the online LDA',
+                        type=float, default=0.1)
+    parser.add_argument('--no-plot', help='Do not plot recorded iterations',
+                        dest='plot', action='store_false')
+    parser.add_argument('--record-queue-size', help='Maximum number of signal chunks and iterations waiting to be recorded',
+                        type=int, default=256)
+    parser.add_argument('--record-backpressure', help='Wait for the recorder instead of dropping data',
+                        action='store_true')
+    parser.add_argument('--metrics-interval', help='Interval in seconds between metrics reports (0 disables them)',
+                        type=float, default=0.0)
+    parser.add_argument('--metrics-file', help='File to export metrics to in Prometheus text format')
+    parser.add_argument('--metrics-port', help='Local port serving metrics in Prometheus text format',
+                        type=int, default=None)
+    parser.add_argument('--processes', help='Number of worker processes for ICA and classifier fitting '
+                        '(0 fits in threads)', type=int, default=0)
+
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
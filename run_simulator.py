@@ -0,0 +1,40 @@
+import asyncio
+import logging
+from argparse import ArgumentParser
+
+from model import SessionReader
+from realtime.simulation import CyKitSimulator
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args()
+
+    source = None
+    if args.replay is not None:
+        source = SessionReader(args.replay).signal('raw')
+
+    loop = asyncio.get_event_loop()
+    simulator = loop.run_until_complete(CyKitSimulator(source=source).start(args.address, args.port))
+    print("Streaming {} data on {}:{}".format(
+        "recorded" if source is not None else "synthetic", args.address, simulator.port))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        loop.close()
+
+
+def parse_args():
+    parser = ArgumentParser(description='Stand-in for a CyKit server streaming 14 channels at 128 Hz')
+    parser.add_argument('address', help='Address to listen on', nargs='?', default='localhost')
+    parser.add_argument('port', help='Port to listen on', type=int, nargs='?', default=5151)
+    parser.add_argument('--replay', help='Recorded session directory to stream raw samples from')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+from realtime.app_interaction import connect_to_app
+
+
+async def _wait_after_disconnect():
+    async def accept(reader, writer):
+        writer.close()
+
+    server = await asyncio.start_server(accept, 'localhost', 0)
+    client = await connect_to_app(server.sockets[0].getsockname()[1])
+    try:
+        # A switched-off session is parked here and has to notice that the app went away
+        await asyncio.wait_for(client.wait_for_config_push(), timeout=5)
+    finally:
+        client.stop()
+        server.close()
+        await server.wait_closed()
+
+
+def test_config_push_wait_fails_when_app_disconnects():
+    with pytest.raises(ConnectionError):
+        asyncio.run(_wait_after_disconnect())
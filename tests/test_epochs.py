@@ -0,0 +1,27 @@
+import numpy as np
+
+from model.model import EpochAccumulator
+
+
+def test_epochs_are_kept_in_flash_order():
+    epochs = EpochAccumulator(keep_segments=True)
+    # The second flash completes last, e.g. after its segment was re-anchored
+    for stimulus, start in (('A', 0), ('C', 20), ('B', 10)):
+        epochs.add(stimulus, start, np.full((4, 2), start, dtype=float))
+
+    assert epochs.stimuli == ['A', 'B', 'C']
+    assert epochs.events == [(0, 4), (10, 4), (20, 4)]
+    assert [start for start, _ in epochs.segments] == [0, 10, 20]
+
+
+def test_average_falls_back_to_rejected_epochs():
+    epochs = EpochAccumulator()
+    epochs.add('A', 0, np.ones((4, 2)))
+    epochs.add('A', 10, np.full((4, 2), 3.0))
+    epochs.add('B', 20, np.full((4, 2), 5.0), clean=False)
+    epochs.add('A', 30, np.full((4, 2), 7.0), clean=False)
+
+    stimuli, averages = epochs.average()
+    assert stimuli == ['A', 'B']
+    assert np.allclose(averages[0], 2.0) and np.allclose(averages[1], 5.0)
+    assert epochs.rejected == 2
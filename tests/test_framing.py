@@ -0,0 +1,57 @@
+import pytest
+
+from protocol import (
+    BATCH, CONFIG, FLAG_ACK, FLAG_PUSH, FLASH_ACK, HEADER, QUALITY, SCHEDULE, SIGNALS, VERSION, FrameDecoder,
+    ProtocolError, decode_flash_ack, decode_json, decode_quality, decode_schedule, decode_signal, encode_batch,
+    encode_flash_ack, encode_frame, encode_json, encode_quality, encode_schedule, encode_signal)
+
+
+def test_frames_are_reassembled_from_single_bytes():
+    schedule = [(0, 'keyboard_flash_row', 2, 1.5), (1, 'keyboard_flash_col', 5, 1.625)]
+    quality = [(0, 1.0, 2.0, 3.0), (2, 0.25, 0.5, 75.0)]
+    stream = b''.join([
+        encode_json(CONFIG, {'mode': 'keyboard', 'active': True}, FLAG_PUSH),
+        encode_batch([encode_signal('keyboard_flash_row', 3, ack=7), encode_signal('keyboard_select_letter', 'Q'),
+                      encode_schedule(schedule)]),
+        encode_flash_ack(7, 12.5),
+        encode_quality(quality),
+    ])
+
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(stream)):
+        frames += decoder.feed(stream[i:i + 1])
+
+    assert [(opcode, flags) for opcode, flags, _ in frames] == [
+        (CONFIG, FLAG_PUSH), (SIGNALS['keyboard_flash_row'][0], FLAG_ACK),
+        (SIGNALS['keyboard_select_letter'][0], 0), (SCHEDULE, 0), (FLASH_ACK, 0), (QUALITY, 0)]
+    assert decode_json(frames[0][2]) == {'mode': 'keyboard', 'active': True}
+    assert decode_signal(*frames[1]) == ('keyboard_flash_row', (3,), 7)
+    assert decode_signal(*frames[2]) == ('keyboard_select_letter', ('Q',), None)
+    assert decode_schedule(frames[3][2]) == schedule
+    assert decode_flash_ack(frames[4][2]) == (7, 12.5)
+    assert decode_quality(frames[5][2]) == quality
+
+
+def test_truncated_frame_in_batch():
+    frame = encode_signal('mouse_flash_class', 1)
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(encode_frame(BATCH, frame + frame[:-1]))
+
+
+def test_version_mismatch():
+    frame = HEADER.pack(VERSION + 1, CONFIG, 0, 0)
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(frame)
+
+
+@pytest.mark.parametrize('decode, payload', [
+    (lambda payload: decode_signal(SIGNALS['keyboard_flash_row'][0], 0, payload), b''),
+    (lambda payload: decode_signal(SIGNALS['keyboard_flash_row'][0], FLAG_ACK, payload), b'\x01'),
+    (decode_flash_ack, b'\x00' * 11),
+    (decode_schedule, encode_schedule([(0, 'mouse_flash_class', 1, 0.0)])[HEADER.size:-1]),
+    (decode_quality, encode_quality([(0, 1.0, 2.0, 3.0)])[HEADER.size:] + b'\x00'),
+])
+def test_wrong_payload_length(decode, payload):
+    with pytest.raises(ProtocolError):
+        decode(payload)
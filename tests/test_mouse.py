@@ -0,0 +1,58 @@
+import numpy as np
+
+from app.mouse import CLICK_CLASS, MouseTargeting
+from app.os_interaction import FakeBackend, Screenshot
+
+
+def test_quadrant_zooms_into_region():
+    targeting = MouseTargeting(1920, 1080)
+    assert targeting.select(3) is None
+    assert targeting.region == (960, 540, 960, 540)
+    assert targeting.select(0) is None
+    assert targeting.region == (960, 540, 480, 270)
+
+
+def test_click_clicks_middle_and_resets():
+    targeting = MouseTargeting(1920, 1080)
+    targeting.select(1)
+    assert targeting.select(CLICK_CLASS) == (1440, 270)
+    assert targeting.region == (0, 0, 1920, 1080)
+
+
+def test_small_quadrant_is_clicked_instead_of_zoomed():
+    targeting = MouseTargeting(64, 64, min_size=16)
+    assert targeting.select(0) is None
+    assert targeting.region == (0, 0, 32, 32)
+    # Its quadrants would be 8 pixels wide, below the minimum size
+    assert targeting.select(3) == (24, 24)
+    assert targeting.region == (0, 0, 64, 64)
+
+
+def test_odd_sizes_are_covered_by_quadrants():
+    targeting = MouseTargeting(101, 51)
+    quadrants = [targeting.quadrant(i) for i in range(4)]
+    assert sum(w * h for _, _, w, h in quadrants) == 101 * 51
+
+
+def test_tile_is_decimated_to_at_least_twice_the_requested_size():
+    screenshot = Screenshot(0, 0, np.zeros((1080, 1920, 3), dtype=np.uint8))
+    tile = screenshot.tile(0, 0, 960, 540, 100, 50)
+    assert tile.shape[1] >= 200 and tile.shape[0] >= 100
+    assert tile.shape[1] < 960 and tile.shape[0] < 540
+    assert tile.flags['C_CONTIGUOUS']
+
+
+def test_small_tile_is_not_decimated():
+    screenshot = Screenshot(0, 0, np.zeros((1080, 1920, 3), dtype=np.uint8))
+    assert screenshot.tile(10, 20, 300, 200, 300, 200).shape == (200, 300, 3)
+
+
+def test_fake_backend_records_input():
+    backend = FakeBackend(width=640, height=480, left=-640)
+    screenshot = backend.grab_screen()
+    assert (screenshot.width, screenshot.height, screenshot.left) == (640, 480, -640)
+    backend.click(-320, 240)
+    backend.send_keys('A')
+    assert backend.grabs == 1
+    assert backend.clicks == [(-320, 240)]
+    assert backend.keys == ['A']
@@ -0,0 +1,41 @@
+import numpy as np
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from model.features import FeatureExtractor
+from model.model import EpochAccumulator, OnlineLDAModel
+from model.online import OnlineLDA
+
+
+def test_online_lda_matches_sklearn():
+    rng = np.random.RandomState(0)
+    X = rng.randn(300, 20) @ rng.randn(20, 20)
+    y = (rng.rand(300) < 0.2).astype(int)
+    X[y == 1] += 0.5
+
+    lda = OnlineLDA(0.1)
+    for i in range(0, len(X), 70):
+        lda.partial_fit(X[i:i + 70], y[i:i + 70])
+
+    expected = make_pipeline(StandardScaler(), LinearDiscriminantAnalysis(solver='lsqr', shrinkage=0.1)).fit(X, y)
+    assert np.allclose(lda.predict_proba(X), expected.predict_proba(X))
+
+
+def test_saved_statistics_of_other_features_are_discarded(tmp_path):
+    rng = np.random.RandomState(0)
+    lda = OnlineLDA()
+    lda.partial_fit(rng.randn(10, 168), [0] * 8 + [1] * 2)
+    (tmp_path / "models").mkdir()
+    OnlineLDA.save_state(lda.get_state(), tmp_path / "models" / OnlineLDAModel.FILENAME)
+
+    epochs = EpochAccumulator()
+    for stimulus in range(6):
+        epochs.add(stimulus, 16 * stimulus, rng.randn(128, 14))
+
+    model = OnlineLDAModel(extractor=FeatureExtractor(decimation=2), plot=False, directory=tmp_path)
+    try:
+        # Scoring before any training sees an unfitted model instead of failing on the saved 168 features
+        assert model.score(epochs) == {stimulus: 0.5 for stimulus in range(6)}
+    finally:
+        model.close()
@@ -0,0 +1,49 @@
+import numpy as np
+import scipy.signal
+
+from model import CachedICA, ConcretePreprocessingStrategy, StreamingPreprocessingStrategy
+
+
+def test_streaming_bandpass_matches_offline_filtering():
+    rng = np.random.RandomState(0)
+    signal = 4200.0 + 10.0 * rng.randn(2000, 14)
+    strategy = StreamingPreprocessingStrategy()
+
+    chunks, start = [], 0
+    while start < len(signal):
+        size = rng.randint(1, 64)
+        chunks.append(strategy._bandpass(signal[start:start + size]))
+        start += size
+
+    expected = scipy.signal.sosfilt(strategy._sos, signal, axis=0)
+    assert np.allclose(np.concatenate(chunks), expected)
+
+
+def test_streaming_batches_match_offline_preprocessing():
+    rng = np.random.RandomState(1)
+    signal = 4200.0 + 10.0 * rng.randn(1024, 14)
+    strategy = StreamingPreprocessingStrategy(chunk_size=16)
+
+    streamed = np.concatenate([strategy.preprocess_batch(signal[i:i + 16]) for i in range(0, len(signal), 16)])
+
+    # Without a cached ICA, streaming preprocessing is the bandpass and subsampling of the whole signal
+    offline = ConcretePreprocessingStrategy()
+    expected = offline._subsample(offline._bandpass(signal), offline.subsample_rate)
+    assert np.allclose(streamed, expected)
+
+
+def test_first_ica_fit_runs_in_the_background(tmp_path):
+    rng = np.random.RandomState(2)
+    sources = rng.laplace(size=(1024, 14))
+    signal = sources @ rng.randn(14, 14)
+    ica = CachedICA(calibration_size=512, filename=tmp_path / "ica_unmixing.npz")
+
+    # The batch that fills the window submits the fit, and batches pass through until it is done
+    for i in range(0, 512, 64):
+        batch = signal[i:i + 64]
+        assert np.array_equal(ica.transform(batch), batch)
+    ica._refit.result()
+
+    batch = signal[512:576]
+    assert not np.array_equal(ica.transform(batch), batch)
+    assert (tmp_path / "ica_unmixing.npz").exists()
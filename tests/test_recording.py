@@ -0,0 +1,30 @@
+import numpy as np
+
+from model import SessionReader
+from model.model import EpochAccumulator, RecordModel
+
+
+def _record_period(model, start, num_samples=64):
+    model.start_recording()
+    signal = np.full((num_samples, 14), start, dtype=np.float32)
+    model.record_signal(start, signal, signal)
+    epochs = EpochAccumulator()
+    epochs.add(('row', 0), start + 16, signal[16:48])
+    model.train_iteration(epochs, [('row', 0)])
+
+
+def test_every_active_period_gets_its_own_recording(tmp_path):
+    model = RecordModel(plot=False, directory=tmp_path)
+    _record_period(model, 1000)
+    # A long idle period later, the next recording starts at sample 0 again instead of after a gap
+    _record_period(model, 500000)
+    model.close()
+
+    directories = sorted(p.parent for p in (tmp_path / "data").glob("*/meta.json"))
+    assert len(directories) == 2
+    for directory, start in zip(directories, (1000, 500000)):
+        reader = SessionReader(directory)
+        assert len(reader.signal()) == 64
+        stimuli, segments, target = reader.iteration(0)
+        assert stimuli == [('row', 0)] and target == [('row', 0)]
+        assert segments[0][0] == 16 and np.all(segments[0][1] == start)
@@ -0,0 +1,168 @@
+import hashlib
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+from sklearn.model_selection import KFold
+
+import model
+from model import FeatureExtractor, LDAModel, SessionReader, average_segments, make_classifier
+from run_session import profile_directory
+
+HASHED_FILES = ['meta.json', 'events.bin', 'preprocessed.f32']
+# Bumped whenever the cached features change shape, so that stale caches are not reused
+FEATURES_VERSION = 2
+
+
+def featurize(directory):
+    records = []
+    for stimuli, segments, target in SessionReader(directory).iterations(train=True):
+        keys = list(dict.fromkeys(stimuli))
+        features = []
+        for num_repetitions in range(1, _count_repetitions(stimuli) + 1):
+            features.append(_average_repetitions(stimuli, segments, keys, num_repetitions))
+        records.append({
+            'keys': keys,
+            'y': np.array([int(k in target) for k in keys]),
+            'features': np.array(features, dtype=np.float32),
+        })
+    return records
+
+
+def _count_repetitions(stimuli):
+    counts = defaultdict(int)
+    for stimulus in stimuli:
+        counts[stimulus] += 1
+    return min(counts.values())
+
+
+def _average_repetitions(stimuli, segments, keys, num_repetitions):
+    seen = defaultdict(int)
+    selected_stimuli, selected_segments = [], []
+    for stimulus, segment in zip(stimuli, segments):
+        if seen[stimulus] < num_repetitions:
+            selected_stimuli.append(stimulus)
+            selected_segments.append(segment)
+        seen[stimulus] += 1
+
+    averaged_keys, X = average_segments(selected_stimuli, selected_segments)
+    order = [averaged_keys.index(k) for k in keys]
+    return X[order]
+
+
+def _hash_recording(directory):
+    h = hashlib.sha1(str(FEATURES_VERSION).encode('ascii'))
+    for name in HASHED_FILES:
+        path = directory / name
+        if not path.exists():
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def load_features(directories, cache_directory, jobs=None):
+    cache_directory.mkdir(parents=True, exist_ok=True)
+
+    records, missing = {}, {}
+    for directory in directories:
+        cache_path = cache_directory / "{}.joblib".format(_hash_recording(directory))
+        if cache_path.exists():
+            records[directory] = joblib.load(cache_path)
+        else:
+            missing[directory] = cache_path
+
+    print("{} recording(s) cached, {} to featurize".format(len(records), len(missing)))
+    if missing:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for directory, result in zip(missing, executor.map(featurize, missing)):
+                joblib.dump(result, missing[directory])
+                records[directory] = result
+
+    return [record for directory in directories for record in records[directory]]
+
+
+def select(keys, probs):
+    if all(isinstance(k, tuple) for k in keys):
+        groups = defaultdict(list)
+        for k, p in zip(keys, probs):
+            groups[k[0]].append((p, k))
+        return {max(group)[1] for group in groups.values()}
+    return {keys[int(np.argmax(probs))]}
+
+
+def cross_validate(records, folds, make_extractor):
+    correct, total = defaultdict(int), defaultdict(int)
+
+    splitter = KFold(n_splits=min(folds, len(records)), shuffle=True)
+    for train_idx, test_idx in splitter.split(records):
+        clf = make_classifier(make_extractor())
+        clf.fit(np.concatenate([records[i]['features'][-1] for i in train_idx]),
+                np.concatenate([records[i]['y'] for i in train_idx]))
+
+        for i in test_idx:
+            record = records[i]
+            target = {k for k, y in zip(record['keys'], record['y']) if y}
+            for r, X in enumerate(record['features'], 1):
+                probs = clf.predict_proba(X)[:, 1]
+                correct[r] += select(record['keys'], probs) == target
+                total[r] += 1
+
+    print("Repetitions  Accuracy  Iterations")
+    for r in sorted(total):
+        print("{:>11}  {:>8.3f}  {:>10}".format(r, correct[r] / total[r], total[r]))
+
+
+def main():
+    args = parse_args()
+
+    # Sessions run with a profile (as every run_host.py session is) record and load models there
+    base_directory = profile_directory(args) or model.CONFIG_DIRECTORY
+    data_directory = base_directory / "data"
+    directories = sorted(p.parent for p in data_directory.glob("*/meta.json"))
+    records = load_features(directories, base_directory / "cache" / "features", args.jobs)
+    if not records:
+        print("No training iterations found in {}".format(data_directory))
+        return
+
+    def make_extractor():
+        return FeatureExtractor(window=args.feature_window, decimation=args.decimation,
+                                channels=args.channels, xdawn_filters=args.xdawn)
+
+    print("{} training iteration(s)".format(len(records)))
+    if args.folds > 1 and len(records) > 1:
+        cross_validate(records, args.folds, make_extractor)
+
+    clf = make_classifier(make_extractor())
+    clf.fit(np.concatenate([record['features'][-1] for record in records]),
+            np.concatenate([record['y'] for record in records]))
+
+    directory = base_directory / "models"
+    directory.mkdir(parents=True, exist_ok=True)
+    joblib.dump(clf, str(directory / LDAModel.FILENAME))
+    print("Model saved to {}".format(directory / LDAModel.FILENAME))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Train the LDA model on recorded training sessions')
+    parser.add_argument('--folds', help='Number of cross-validation folds (1 disables cross-validation)',
+                        type=int, default=5)
+    parser.add_argument('--jobs', help='Number of featurization processes', type=int, default=None)
+    parser.add_argument('--profile', help='Name of the user profile to train on and save the model to '
+                        '(~/.bci by default)')
+    parser.add_argument('--feature-window', help='Part of each epoch used as features, in ms after the flash',
+                        type=float, nargs=2, default=[200.0, 600.0])
+    parser.add_argument('--decimation', help='Number of samples averaged into one feature sample',
+                        type=int, default=4)
+    parser.add_argument('--channels', help='Indices of the channels used as features (all by default)',
+                        type=int, nargs='+', default=None)
+    parser.add_argument('--xdawn', help='Number of xDAWN spatial filters (0 uses the channels as is)',
+                        type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()